@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Benchmarks workflow generation against a synthetic raw stub tree.
+#
+#   bench/bench_hcswif.py                         # 1k, 10k and 100k segments
+#   bench/bench_hcswif.py --sizes 1000 10000      # only some sizes
+#   bench/bench_hcswif.py --cases replay_file     # only some cases
+#
+# A temporary directory gets a raw directory of tape stubs (10 segments per
+# run), a run list, a command list with its filelist and a replay tarball.
+# hcswif's directories are pointed at it, and each case runs hcswif.main()
+# in its own python process so the wall time, peak RSS, filesystem calls and
+# phase times (from hcswif --profile) belong to that case alone. Results are appended to bench/results.jsonl
+# with the git revision they were measured at, and compared with the last
+# result of the same case and size.
+
+import os
+import sys
+import json
+import time
+import shutil
+import tarfile
+import argparse
+import datetime
+import tempfile
+import warnings
+import contextlib
+import subprocess
+
+bench_dir = os.path.dirname(os.path.realpath(__file__))
+hcswif_dir = os.path.dirname(bench_dir)
+results_file = os.path.join(bench_dir, 'results.jsonl')
+segs_per_run = 10
+
+# hcswif arguments of each case. {root} is the synthetic tree and {runs}
+# the number of runs in it.
+cases = { 'replay_file'        : ['--mode', 'replay', '--spectrometer', 'NPS_COIN', '--run', 'file', '{root}/runs.txt',
+                                  '--specify_replay', '{root}/nps_replay.tar.gz', '--account', 'hallc', '--name', 'bench'],
+          'replay_index_cold'  : ['--mode', 'replay', '--spectrometer', 'NPS_COIN', '--run', 'index', '1-{runs}',
+                                  '--specify_replay', '{root}/nps_replay.tar.gz', '--account', 'hallc', '--name', 'bench'],
+          'replay_index_warm'  : ['--mode', 'replay', '--spectrometer', 'NPS_COIN', '--run', 'index', '1-{runs}',
+                                  '--specify_replay', '{root}/nps_replay.tar.gz', '--account', 'hallc', '--name', 'bench'],
+          'command'            : ['--mode', 'command', '--command', 'file', '{root}/commands.txt',
+                                  '--filelist', '{root}/filelist.txt', '--account', 'hallc', '--name', 'bench']}
+
+#------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000, 100000],
+            help='numbers of raw segments to benchmark, default is 1000 10000 100000')
+    parser.add_argument('--cases', nargs='+', default=sorted(cases),
+            help='cases to run, default is all of ' + ' '.join(sorted(cases)))
+    parser.add_argument('--keep', action='store_true',
+            help='keep the synthetic trees instead of removing them')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        runChild(*args.child)
+        return
+
+    revision = getRevision()
+    history = loadResults()
+    for size in args.sizes:
+        root = tempfile.mkdtemp(prefix='hcswif_bench_')
+        try:
+            makeTree(root, size)
+            # The warm index case needs the index the cold case leaves behind
+            for case in sorted(args.cases, key=lambda c: (c!='replay_index_cold', c)):
+                result = runCase(case, root, size)
+                result['revision'] = revision
+                result['date'] = datetime.datetime.now().isoformat(timespec='seconds')
+                printResult(result, history.get((case, size)))
+                with open(results_file, 'a') as f:
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
+        finally:
+            if args.keep:
+                print('Kept: ' + root)
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+
+#------------------------------------------------------------------------------
+def getRevision():
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=hcswif_dir,
+                                           universal_newlines=True).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'hcswif.py'], cwd=hcswif_dir)
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+#------------------------------------------------------------------------------
+def loadResults():
+    # Last result of each (case, size)
+    history = {}
+    if os.path.isfile(results_file):
+        with open(results_file, 'r') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                history[(result['case'], result['size'])] = result
+    return history
+
+#------------------------------------------------------------------------------
+def makeTree(root, size):
+    # size segments in size/segs_per_run runs, spread over tape volumes of
+    # 1000 files each
+    raw = os.path.join(root, 'raw')
+    for d in ['raw', 'jsons', 'out', 'err', 'vol']:
+        os.makedirs(os.path.join(root, d))
+    nruns = max(1, size//segs_per_run)
+    with open(os.path.join(root, 'runs.txt'), 'w') as runs, \
+         open(os.path.join(root, 'commands.txt'), 'w') as commands:
+        n = 0
+        for run in range(1, nruns + 1):
+            for seg in range(segs_per_run):
+                stub_size = 100000000 + (run*7919 + seg*104729) % 1900000000
+                with open(os.path.join(raw, 'nps_coin_%04d.dat.%d' % (run, seg)), 'w') as stub:
+                    stub.write('bfid=%d\nsize=%d\nvolser=V%05d\nfilepos=%d\n' % (n, stub_size, n//1000, n%1000))
+                runs.write('%d %d %d\n' % (run, seg, stub_size))
+                commands.write('%s/some_script.sh %04d %d\n' % (hcswif_dir, run, seg))
+                n += 1
+    with open(os.path.join(root, 'filelist.txt'), 'w') as f:
+        f.write('PATTERN run=1 seg=2\n')
+        f.write(os.path.join(raw, 'nps_coin_{run}.dat.0') + '\n')
+        f.write(os.path.join(raw, 'nps_coin_{run}.dat.{seg}') + '\n')
+    tar_path = os.path.join(root, 'nps_replay.tar.gz')
+    with tarfile.open(tar_path, 'w:gz') as tar:
+        tar.add(os.path.join(hcswif_dir, 'setup.sh'), arcname='nps_replay/setup.sh')
+
+#------------------------------------------------------------------------------
+def runCase(case, root, size):
+    nruns = max(1, size//segs_per_run)
+    start = time.time()
+    output = subprocess.check_output([sys.executable, os.path.realpath(__file__), '--child', case, root, str(nruns)],
+                                     universal_newlines=True)
+    result = json.loads(output.strip().splitlines()[-1])
+    result.update({'case': case, 'size': size, 'process_s': round(time.time() - start, 3)})
+    return result
+
+#------------------------------------------------------------------------------
+def runChild(case, root, nruns):
+    sys.path.insert(0, hcswif_dir)
+    warnings.simplefilter('ignore')
+    import hcswif
+    import resource
+
+    # Point every hcswif directory at the synthetic tree
+    hcswif.raw_dir = os.path.join(root, 'raw')
+    hcswif.json_dir = os.path.join(root, 'jsons')
+    hcswif.std_out = os.path.join(root, 'out')
+    hcswif.std_err = os.path.join(root, 'err')
+    hcswif.voli_path = os.path.join(root, 'vol')
+    hcswif.tape_out = os.path.join(root, 'mss') + '/'
+    hcswif.index_file = os.path.join(root, 'jsons', 'nps_raw_index.json')
+    hcswif.resource_db_file = os.path.join(root, 'jsons', 'nps_resource_db.json')
+    hcswif.report_file = os.path.join(root, 'jsons', 'nps_report_index.json')
+
+    # hcswif's own profile counts the filesystem calls and times the phases
+    argv = [arg.format(root=root, runs=nruns) for arg in cases[case]] + ['--profile', 'True']
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        hcswif.main(argv)
+    wall = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Count the jobs written, after the measurement
+    with open(os.path.join(root, 'jsons', 'bench_profile.json'), 'r') as f:
+        profile = json.load(f)
+    fs_calls = {}
+    for calls in profile['fs'].values():
+        for name, entry in calls.items():
+            fs_calls[name] = fs_calls.get(name, 0) + entry['calls']
+    phases = {name: entry['secs'] for name, entry in profile['phases'].items()}
+    njobs = 0
+    with open(os.path.join(root, 'jsons', 'bench.json'), 'r') as f:
+        for line in f:
+            njobs += line.count('"command":')
+    print(json.dumps({'wall_s': round(wall, 3), 'peak_rss_mb': round(peak_rss/1024., 1),
+                      'fs_calls': fs_calls, 'phases': phases, 'jobs': njobs}))
+
+#------------------------------------------------------------------------------
+def printResult(result, previous):
+    line = '%-18s %7d segments: %8.2f s %8.1f MB %7d jobs  fs calls: %s' % (
+        result['case'], result['size'], result['wall_s'], result['peak_rss_mb'], result['jobs'],
+        ' '.join('%s=%d' % item for item in sorted(result['fs_calls'].items())))
+    if previous!=None and previous.get('wall_s'):
+        line += '  (%+.0f%% time, %+.0f%% RSS vs %s)' % (
+            100.*(result['wall_s']/previous['wall_s'] - 1), 100.*(result['peak_rss_mb']/previous['peak_rss_mb'] - 1),
+            previous.get('revision', '?'))
+    print(line)
+
+#------------------------------------------------------------------------------
+if __name__ == "__main__":
+    main()
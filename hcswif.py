@@ -4,13 +4,26 @@ import os
 import glob
 import re
 import sys
-import copy
+import string
+import fnmatch
 import json
+import gzip
+import array
 import shutil
 import getpass
 import argparse
+import hashlib
+import shlex
+import time
+import cProfile
+import builtins
+import contextlib
 import datetime
 import warnings
+import itertools
+import threading
+import subprocess
+import concurrent.futures
 
 #------------------------------------------------------------------------------
 # Define environment
@@ -22,30 +35,23 @@ std_err = os.path.join('/farm_out/', getpass.getuser() , 'nps_replay_stderr/')
 json_dir = os.path.join('/group/nps/', getpass.getuser() , 'hcswif/jsons')
 tape_out = os.path.join('/mss/hallc/c-nps/analysis/online/replays/')
 voli_path = os.path.join('/volatile/hallc/nps/', getpass.getuser())
-if not os.path.isdir(std_out):
-    warnings.warn('std_out: ' + std_out + ' does not exist')
-if not os.path.isdir(std_err):
-    warnings.warn('std_err: ' + std_err + ' does not exist')
-
-if not os.path.isdir(json_dir):
-    warnings.warn('json_dir: ' + json_dir + ' does not exist')
-
-# Where is your raw data?
-sp22_raw_dir = '/mss/hallc/xem2/raw'
-sp18_raw_dir = '/mss/hallc/spring17/raw'
-sp19_raw_dir = '/mss/hallc/jpsi-007/raw'
-cafe_raw_dir = '/mss/hallc/c-cafe-2022/raw'
-nps_raw_dir  = '/mss/hallc/c-nps/raw'
-if not os.path.isdir(sp22_raw_dir):
-    warnings.warn('raw_dir: ' + sp22_raw_dir + ' does not exist')
-if not os.path.isdir(sp18_raw_dir):
-    warnings.warn('raw_dir: ' + sp18_raw_dir + ' does not exist')
-if not os.path.isdir(sp19_raw_dir):
-    warnings.warn('raw_dir: ' + sp19_raw_dir + ' does not exist')
-if not os.path.isdir(cafe_raw_dir):
-    warnings.warn('raw_dir: ' + cafe_raw_dir + ' does not exist')
-if not os.path.isdir(nps_raw_dir):
-    warnings.warn('raw_dir: ' + nps_raw_dir + ' does not exist')
+
+# Where is your raw data, and what are its files called (CODA stem of a run,
+# followed by .dat.<segment>)? An experiment profile may change these.
+raw_dir = '/mss/hallc/c-nps/raw'
+coda_stem_format = 'nps_coin_%04d'
+
+# Which replay tarball do jobs use if --specify_replay is not given?
+default_replay_tar = os.path.join('/group/nps/', getpass.getuser(), 'nps_replay.tar.gz')
+
+# Where do you want the index of raw tape stubs (run, segment, size, mtime, tape)?
+index_file = os.path.join(json_dir, 'nps_raw_index.json')
+
+# Where do you want the resource usage read back from past job logs?
+resource_db_file = os.path.join(json_dir, 'nps_resource_db.json')
+
+# Where do you want the index of job logs read by --mode report?
+report_file = os.path.join(json_dir, 'nps_report_index.json')
 
 # Where is hcswif?
 hcswif_dir = os.path.dirname(os.path.realpath(__file__))
@@ -55,34 +61,98 @@ now = datetime.datetime.now()
 datestr = now.strftime("%Y%m%d%H%M")
 hcswif_prefix = 'hcswif' + datestr
 
+# Experiment profiles: the replay script, ROOT output and disk sizing of
+# each spectrometer, and optionally a raw_dir, coda_stem, tape_out and
+# replay_tar replacing the ones above. See hcswif_experiments.json.
+experiments_file = os.path.join(hcswif_dir, 'hcswif_experiments.json')
+default_experiment = 'nps'
+
 #------------------------------------------------------------------------------
 # This is the main body of hcswif
-def main():
-    # Parse the arguments specified by the user
-    parsed_args = parseArgs()
-
-    # Turn those arguments into a swif workflow in json format and
-    # generate a filename for the json file to write.
-    workflow, outfile = getWorkflow(parsed_args)
-
-    # Write the workflow to disk
-    writeWorkflow(workflow, outfile)
+def main(argv=None):
+    # Parse the arguments specified by the user (or argv, without the
+    # program name, when hcswif is called from python)
+    parsed_args = parseArgs(argv)
+
+    # Files checked by an earlier call from python may have changed since
+    clearCaches()
+
+    # Directories and spectrometers of the experiment
+    setExperiment(parsed_args)
+
+    # Index mode only refreshes the raw stub index and writes a run list
+    if parsed_args.mode!=None and parsed_args.mode[0].lower()=='index':
+        writeIndexRunList(parsed_args)
+        return
+
+    # jcache mode stages, pins or writes to tape the files of a run list
+    if parsed_args.mode!=None and parsed_args.mode[0].lower()=='jcache':
+        runJcache(parsed_args)
+        return
+
+    # Report mode summarizes the logs of workflows already written
+    if parsed_args.mode!=None and parsed_args.mode[0].lower()=='report':
+        writeReport(parsed_args)
+        return
+
+    # Resubmit mode writes a workflow of the failed jobs of a workflow
+    if parsed_args.mode!=None and parsed_args.mode[0].lower()=='resubmit':
+        writeResubmitWorkflow(parsed_args)
+        return
+
+    # Archive mode writes a workflow that puts finished ROOT output on tape
+    if parsed_args.mode!=None and parsed_args.mode[0].lower()=='archive':
+        writeArchiveWorkflow(parsed_args)
+        return
+
+    # Time each phase and count filesystem calls while the workflow is made
+    profile = getProfile(parsed_args)
+    if profile:
+        startProfile(profile=='cprofile')
+    try:
+        # Turn those arguments into a swif workflow in json format and
+        # generate a filename for the json file to write.
+        workflow, outfile = getWorkflow(parsed_args)
+
+        # Write the workflow to disk, split into several workflows if requested
+        with profilePhase('write'):
+            if parsed_args.shard_size==None:
+                writeWorkflow(workflow, outfile, getCompact(parsed_args))
+                wf_files = [outfile]
+            else:
+                manifest = writeShardedWorkflow(workflow, outfile, parsed_args)
+                wf_files = [entry['file'] for entry in manifest['shards']]
+
+        # Create the workflows in swif2 instead of leaving the import to the user
+        if getSubmit(parsed_args):
+            with profilePhase('submit'):
+                for wf_file in wf_files:
+                    submitWorkflow(wf_file, parsed_args)
+    finally:
+        if profile:
+            state = stopProfile()
+    if profile:
+        writeProfile(state, outfile)
 
 #------------------------------------------------------------------------------
-def parseArgs():
+def parseArgs(argv=None):
     parser = argparse.ArgumentParser()
 
     # Add arguments
     parser.add_argument('--mode', nargs=1, dest='mode',
-            help='type of workflow (replay or command)')
+            help='type of workflow (replay or command), index to refresh the raw stub index, jcache to get/pin/put the files of a run list, report to summarize the job logs of workflows, resubmit to write a workflow of the failed jobs of a workflow, or archive to write a workflow that puts the ROOT output of a run list on tape')
     parser.add_argument('--spectrometer', nargs=1, dest='spectrometer',
-                        help='spectrometer to analyze (HMS_ALL, NPS_ALL, HMS_PROD, VLD_REPLAY, NPS_PROD, HMS_COIN, NPS_SKIM, NPS_COIN, NPS_COIN_SCALER, HMS_SCALER, NPS_SCALER)')
+                        help='spectrometer to analyze, one of those of the experiment (for nps: HMS_ALL, NPS_ALL, HMS_PROD, VLD_REPLAY, NPS_PROD, HMS_COIN, NPS_SKIM, NPS_COIN, NPS_COIN_SCALER, HMS_SCALER, NPS_SCALER)')
+    parser.add_argument('--experiment', nargs=1, dest='experiment',
+                        help='experiment profile to use from the experiment config, default is ' + default_experiment)
+    parser.add_argument('--experiment_config', nargs=1, dest='experiment_config',
+                        help='experiment config file, default is ' + experiments_file)
     parser.add_argument('--run', nargs='+', dest='run',
-            help='a list of run numbers and ranges; or a file listing run numbers')
+            help='a list of run numbers and ranges; or a file listing run numbers; or index followed by runs and ranges to query the raw stub index')
     parser.add_argument('--events', nargs=1, dest='events',
             help='number of events to analyze (default=all)')
     parser.add_argument('--name', nargs=1, dest='name',
-            help='workflow name')
+            help='workflow name; in report mode, only report on this workflow and its shards; in resubmit mode, the workflow (and its shards) to resubmit the failed jobs of')
     parser.add_argument('--replay', nargs=1, dest='replay',
             help='hcana replay script; path relative to hallc_replay')
     parser.add_argument('--command', nargs="+", dest='command',
@@ -105,26 +175,100 @@ def parseArgs():
             help='Write the output to mss, default is false')
     parser.add_argument('--all_segs', nargs=1, dest='all_segs',
             help='Add all segments of a run to each job, default is false')
+    parser.add_argument('--disk_factor', nargs=1, dest='disk_factor',
+            help='safety factor applied to the disk space estimated from the input sizes, default depends on the spectrometer')
+    parser.add_argument('--pack', nargs=1, dest='pack',
+            help='Replay N segments in parallel in each N-core job, segments are packed by size so they finish together')
+    parser.add_argument('--seg_group', nargs=1, dest='seg_group',
+            help='Replay N segments of a run in each job so segment 0 is only staged once per job. 0 puts every segment of a run in one job')
     parser.add_argument('--specify_replay', nargs=1, dest='specify_replay',
             help='Specify the TAR for this nps_replay. Absolute path, default is assumed /group/nps/$USER/nps_replay.tar.gz.')
     parser.add_argument('--constraint', nargs='+', dest='constraint',
             help='user defined SWIF2 constraints (slurm feature).  Space separated if multiple')
     parser.add_argument('--apptainer', nargs=1, dest='apptainer',
                     help='Specify path to apptainer image.')
-
-    print("Ensure your analyzer can compule with the default OS")
-    print("Currently no check on constraints.  See the scicomp Slurm Info page for the latest constraints.")
+    parser.add_argument('--compact', nargs=1, dest='compact',
+            help='Write the workflow json without indentation, one job per line, default is false')
+    parser.add_argument('--shard_size', nargs=1, dest='shard_size',
+            help='Split the workflow into several workflows of at most N jobs each, listed in a manifest')
+    parser.add_argument('--shard_by', nargs=1, dest='shard_by',
+            help='jobs (default) fills each shard with N jobs, run keeps all jobs of a run in the same shard, tape keeps jobs reading the same tape volume together (implies tape_order)')
+    parser.add_argument('--incremental', nargs=1, dest='incremental',
+            help='Only generate jobs whose ROOT output is missing or older than its raw data (replay mode only), default is false')
+    parser.add_argument('--output_dir', nargs='+', dest='output_dir',
+            help='Directories searched for existing ROOT output in incremental and archive mode, in addition to volatile (and cache and tape in incremental mode)')
+    parser.add_argument('--tape_order', nargs=1, dest='tape_order',
+            help='Sort jobs by the tape volume and position of their input files, default is false')
+    parser.add_argument('--jcache_batches', nargs=1, dest='jcache_batches',
+            help='Write a script of jcache get commands for the inputs, one batch per tape volume in tape order (implies tape_order)')
+    parser.add_argument('--jcache_batch_size', nargs=1, dest='jcache_batch_size',
+            help='Maximum number of files per jcache get in the jcache_batches script, default is 100')
+    parser.add_argument('--batch_size', nargs=1, dest='batch_size',
+            help='Maximum number of files per jcache request (jcache mode), or of jobs between progress reports when submitting, default is 100')
+    parser.add_argument('--jcache_action', nargs=1, dest='jcache_action',
+            help='get (default) or pin the raw data of the runs, or put their replay output from /cache to tape (jcache mode only)')
+    parser.add_argument('--jcache_cmd', nargs=1, dest='jcache_cmd',
+            help='jcache executable to call, default is jcache (jcache mode and jcache_batches)')
+    parser.add_argument('--inflight', nargs=1, dest='inflight',
+            help='maximum number of jcache or swif2 requests running at once, default is 4')
+    parser.add_argument('--submit', nargs=1, dest='submit',
+            help='Create the workflow in swif2 and add its jobs after writing it, default is false. Jobs already added are skipped when run again')
+    parser.add_argument('--swif2_cmd', nargs=1, dest='swif2_cmd',
+            help='swif2 executable to call when submitting, and in resubmit mode to ask swif2 which jobs failed before they started, default is swif2')
+    parser.add_argument('--pin_days', nargs=1, dest='pin_days',
+            help='number of days to pin files for, default is 60 with pin, and not pinned with get (jcache mode only)')
+    parser.add_argument('--merge', nargs=1, dest='merge',
+            help='Add jobs that hadd the segment outputs of each run once all of its segment jobs are done, default is false (replay mode only)')
+    parser.add_argument('--merge_fanin', nargs=1, dest='merge_fanin',
+            help='Maximum number of files per merge job, runs with more segments are merged in a tree, default is 0 (no limit)')
+    parser.add_argument('--merge_cleanup', nargs=1, dest='merge_cleanup',
+            help='Have the last merge job of each run remove the segment copies and partial merges of the run once its hadd succeeded, default is true')
+    parser.add_argument('--split_size', nargs=1, dest='split_size',
+            help='Replay segments larger than this many bytes in event ranges of about this size, one job per range')
+    parser.add_argument('--split_time', nargs=1, dest='split_time',
+            help='Replay segments in event ranges that take about this many seconds, from the resource usage of past jobs')
+    parser.add_argument('--event_bytes', nargs=1, dest='event_bytes',
+            help='Average raw bytes per event used to split segments, default is taken from the logs of past jobs')
+    parser.add_argument('--replay_cache', nargs=1, dest='replay_cache',
+            help='Unpack the replay TAR once per node into a cache keyed by its hash instead of staging and untarring it in every job, default is false')
+    parser.add_argument('--estimate', nargs=1, dest='estimate',
+            help='Set time_secs and ram_bytes of each job from the resource usage of past jobs with the same replay script, default is false (replay mode only)')
+    parser.add_argument('--resource_db', nargs=1, dest='resource_db',
+            help='resource usage database read from the job logs in std_out, default is ' + resource_db_file)
+    parser.add_argument('--archive_size', nargs=1, dest='archive_size',
+            help='bytes of ROOT output per archive job, default is 50000000000 (archive mode only)')
+    parser.add_argument('--archive_method', nargs=1, dest='archive_method',
+            help='swif2 (default) declares the files as swif2 outputs of the archive jobs, jput has the jobs write them to tape with jput (archive mode only)')
+    parser.add_argument('--archive_bundle', nargs=1, dest='archive_bundle',
+            help='Write the files of each archive job to tape as one tar file, listed in <name>_archive_manifest.json, default is false (archive mode only)')
+    parser.add_argument('--min_size', nargs=1, dest='min_size',
+            help='only use segments larger than this many bytes when querying the raw stub index')
+    parser.add_argument('--index', nargs=1, dest='index',
+            help='raw stub index file, default is ' + index_file)
+    parser.add_argument('--runlist', nargs=1, dest='runlist',
+            help='file to write the queried run list to (index mode only), default is stdout')
+    parser.add_argument('--threads', nargs=1, dest='threads',
+            help='number of threads used to scan the filesystem, default is 16')
+    parser.add_argument('--profile', nargs=1, dest='profile',
+            help='Time each phase of the workflow generation and count filesystem calls by path prefix, written to <workflow>_profile.json; cprofile also dumps cProfile stats to <workflow>_profile.prof. Default is false')
+
+    # On stderr, so a run list written to stdout in index mode stays clean
+    print("Ensure your analyzer can compule with the default OS", file=sys.stderr)
+    print("Currently no check on constraints.  See the scicomp Slurm Info page for the latest constraints.", file=sys.stderr)
     # Check if any args specified
-    if len(sys.argv) < 2:
+    if argv==None:
+        argv = sys.argv[1:]
+    if len(argv) < 1:
         raise RuntimeError(parser.print_help())
 
     # Return parsed arguments
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 #------------------------------------------------------------------------------
 def getWorkflow(parsed_args):
     # Initialize
     workflow = initializeWorkflow(parsed_args)
+    checkDir('json_dir', json_dir)
     outfile = os.path.join(json_dir, workflow['name'] + '.json')
 
     # Get jobs
@@ -132,17 +276,258 @@ def getWorkflow(parsed_args):
         raise RuntimeError('Must specify a mode (replay or command)')
     mode = parsed_args.mode[0].lower()
     if mode == 'replay':
-        workflow['jobs'] = getReplayJobs(parsed_args, workflow['name'])
+        with profilePhase('replay_setup'):
+            jobs = getReplayJobs(parsed_args, workflow['name'])
+        workflow['jobs'] = profileJobs('replay_jobs', jobs)
     elif mode == 'command':
-        workflow['jobs'] = getCommandJobs(parsed_args, workflow['name'])
+        with profilePhase('command_setup'):
+            jobs = getCommandJobs(parsed_args, workflow['name'])
+        workflow['jobs'] = profileJobs('command_jobs', jobs)
     else:
         raise ValueError('Mode must be replay or command')
 
+    # Only keep jobs whose outputs are missing or older than their inputs
+    # (packed segments are checked before they are packed, in getReplayJobs)
+    if getIncremental(parsed_args):
+        if mode != 'replay':
+            raise RuntimeError('incremental only works in replay mode')
+        if parsed_args.pack==None:
+            workflow['jobs'] = profileJobs('incremental', getIncrementalJobs(workflow['jobs'], parsed_args))
+
+    # Order jobs by where their inputs sit on tape. Shards by tape are
+    # grouped and ordered as the jobs stream into them, the whole workflow
+    # is only sorted when it is written as one.
+    shard_by_tape = parsed_args.shard_by!=None and parsed_args.shard_by[0].lower()=='tape'
+    if shard_by_tape and parsed_args.shard_size!=None:
+        workflow['jobs'] = profileJobs('tape_order', locateJobsOnTape(workflow['jobs'], parsed_args))
+    elif getTapeOrder(parsed_args) or parsed_args.jcache_batches!=None or shard_by_tape:
+        with profilePhase('tape_order'):
+            workflow['jobs'] = orderJobsByTape(workflow['jobs'], parsed_args)
+
+    # Merge the segment outputs of each run after its segment jobs
+    if getMerge(parsed_args):
+        if mode != 'replay':
+            raise RuntimeError('merge only works in replay mode')
+        if getIncremental(parsed_args):
+            raise RuntimeError('merge cannot be used with incremental')
+        # Antecedents must be in the same workflow as the jobs they wait for
+        sharded = parsed_args.shard_size!=None
+        if sharded and (parsed_args.shard_by==None or parsed_args.shard_by[0].lower()!='run' or parsed_args.pack!=None):
+            raise RuntimeError('merge with shard_size needs shard_by run and cannot be used with pack')
+        if parsed_args.merge_fanin==None:
+            fanin = 0
+        else:
+            fanin = int(parsed_args.merge_fanin[0])
+            if fanin==1:
+                raise ValueError('merge_fanin must be 0 or at least 2')
+        workflow['jobs'] = profileJobs('merge', getMergeJobs(workflow['jobs'], workflow['name'], fanin, sharded,
+                                                             getMergeCleanup(parsed_args)))
+
     # Add account to jobs
     workflow = addCommonJobInfo(workflow, parsed_args)
+    workflow['jobs'] = profileJobs('job_info', workflow['jobs'])
 
     return workflow, outfile
 
+#------------------------------------------------------------------------------
+def getCompact(parsed_args):
+    if parsed_args.compact==None:
+        return False
+    elif parsed_args.compact[0].lower()=='true':
+        return True
+    elif parsed_args.compact[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('compact must be True or False')
+
+#------------------------------------------------------------------------------
+def getIncremental(parsed_args):
+    if parsed_args.incremental==None:
+        return False
+    elif parsed_args.incremental[0].lower()=='true':
+        return True
+    elif parsed_args.incremental[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('incremental must be True or False')
+
+#------------------------------------------------------------------------------
+def getMerge(parsed_args):
+    if parsed_args.merge==None:
+        return False
+    elif parsed_args.merge[0].lower()=='true':
+        return True
+    elif parsed_args.merge[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('merge must be True or False')
+
+#------------------------------------------------------------------------------
+def getMergeCleanup(parsed_args):
+    if parsed_args.merge_cleanup==None:
+        return True
+    elif parsed_args.merge_cleanup[0].lower()=='true':
+        return True
+    elif parsed_args.merge_cleanup[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('merge_cleanup must be True or False')
+
+#------------------------------------------------------------------------------
+def getEstimate(parsed_args):
+    if parsed_args.estimate==None:
+        return False
+    elif parsed_args.estimate[0].lower()=='true':
+        return True
+    elif parsed_args.estimate[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('estimate must be True or False')
+
+#------------------------------------------------------------------------------
+def getSubmit(parsed_args):
+    if parsed_args.submit==None:
+        return False
+    elif parsed_args.submit[0].lower()=='true':
+        return True
+    elif parsed_args.submit[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('submit must be True or False')
+
+#------------------------------------------------------------------------------
+def getArchiveBundle(parsed_args):
+    if parsed_args.archive_bundle==None:
+        return False
+    elif parsed_args.archive_bundle[0].lower()=='true':
+        return True
+    elif parsed_args.archive_bundle[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('archive_bundle must be True or False')
+
+#------------------------------------------------------------------------------
+def getReplayCache(parsed_args):
+    if parsed_args.replay_cache==None:
+        return False
+    elif parsed_args.replay_cache[0].lower()=='true':
+        return True
+    elif parsed_args.replay_cache[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('replay_cache must be True or False')
+
+#------------------------------------------------------------------------------
+def getTapeOrder(parsed_args):
+    if parsed_args.tape_order==None:
+        return False
+    elif parsed_args.tape_order[0].lower()=='true':
+        return True
+    elif parsed_args.tape_order[0].lower()=='false':
+        return False
+    else:
+        raise RuntimeError('tape_order must be True or False')
+
+#------------------------------------------------------------------------------
+# Spectrometer profiles of the experiment in use, by upper case name, with
+# the defaults filled in. Read from the experiment config when first needed.
+spectrometer_profiles = None
+spectrometer_defaults = {'script': '', 'output': '', 'output_path': '', 'output_ratio': 0.5, 'disk_factor': 1.3}
+
+def loadExperiment(name, config_file):
+    with open(config_file, 'r') as f:
+        experiments = json.load(f)
+    if name not in experiments:
+        raise ValueError('Experiment must be one of ' + ', '.join(sorted(experiments)) + ' (' + config_file + ')')
+    experiment = experiments[name]
+
+    profiles = {}
+    for spectrometer, profile in experiment.get('spectrometers', {}).items():
+        profiles[spectrometer.upper()] = dict(spectrometer_defaults, **profile)
+    return experiment, profiles
+
+#------------------------------------------------------------------------------
+# Module values an experiment changed: name -> (value before, value set)
+experiment_overrides = {}
+
+def setExperiment(parsed_args):
+    # The experiment's directories replace the defaults at the top. What an
+    # earlier call (from python) changed is put back first, unless the
+    # caller has set it since.
+    global spectrometer_profiles
+    module = globals()
+    for key, (before, value) in experiment_overrides.items():
+        if module[key] is value:
+            module[key] = before
+    experiment_overrides.clear()
+
+    if parsed_args.experiment==None:
+        name = default_experiment
+    else:
+        name = parsed_args.experiment[0]
+    if parsed_args.experiment_config==None:
+        config_file = experiments_file
+    else:
+        config_file = parsed_args.experiment_config[0]
+
+    experiment, spectrometer_profiles = loadExperiment(name, config_file)
+    values = {}
+    if 'raw_dir' in experiment:
+        values['raw_dir'] = experiment['raw_dir']
+    if 'tape_out' in experiment:
+        values['tape_out'] = experiment['tape_out']
+    if 'replay_tar' in experiment:
+        values['default_replay_tar'] = experiment['replay_tar'].replace('{user}', getpass.getuser())
+    if 'coda_stem' in experiment:
+        values['coda_stem_format'] = experiment['coda_stem']
+        values['stub_re'] = getStubRe(experiment['coda_stem'])
+    for key, value in values.items():
+        experiment_overrides[key] = (module[key], value)
+        module[key] = value
+
+#------------------------------------------------------------------------------
+def getSpectrometerProfile(spectrometer):
+    global spectrometer_profiles
+    if spectrometer_profiles==None:
+        spectrometer_profiles = loadExperiment(default_experiment, experiments_file)[1]
+    if spectrometer.upper() not in spectrometer_profiles:
+        raise ValueError('Spectrometer must be ' + ', '.join(sorted(spectrometer_profiles)))
+    return spectrometer_profiles[spectrometer.upper()]
+
+#------------------------------------------------------------------------------
+def getCodaStem(run):
+    # e.g. nps_coin_0123; the raw files are <coda stem>.dat.<segment>
+    return coda_stem_format % int(run)
+
+def getStubRe(coda_stem):
+    # Matches the raw files of a coda stem format, capturing run and segment
+    pattern = re.sub(r'%0?\d*d', lambda m: r'(\d+)', re.escape(coda_stem), count=1)
+    return re.compile('^' + pattern + r'\.dat\.(\d+)$')
+
+#------------------------------------------------------------------------------
+# Directories are only checked when they are about to be used, once each
+checked_dirs = set()
+
+def checkDir(label, path):
+    if path in checked_dirs:
+        return
+    checked_dirs.add(path)
+    if not os.path.isdir(path):
+        warnings.warn(label + ': ' + path + ' does not exist')
+
+#------------------------------------------------------------------------------
+def getProfile(parsed_args):
+    if parsed_args.profile==None:
+        return False
+    elif parsed_args.profile[0].lower()=='true':
+        return True
+    elif parsed_args.profile[0].lower()=='false':
+        return False
+    elif parsed_args.profile[0].lower()=='cprofile':
+        return 'cprofile'
+    else:
+        raise RuntimeError('profile must be True, False or cprofile')
+
 #------------------------------------------------------------------------------
 def initializeWorkflow(parsed_args):
     workflow = {}
@@ -156,31 +541,23 @@ def initializeWorkflow(parsed_args):
 #------------------------------------------------------------------------------
 def getReplayJobs(parsed_args, wf_name):
     # Spectrometer
+    if parsed_args.spectrometer==None:
+        raise RuntimeError('Must specify the spectrometer to replay')
     spectrometer = parsed_args.spectrometer[0]
-    if spectrometer.upper() not in ['HMS_ALL', 'NPS_ALL', 'VLD_REPLAY', 'HMS_PROD', 'NPS_PROD', 'HMS_COIN', 'NPS_SKIM', 'NPS_COIN', 'NPS_COIN_SCALER', 'HMS_SCALER', 'NPS_SCALER']:
-        raise ValueError('Spectrometer must be HMS_ALL, NPS_ALL, VLD_REPLAY, HMS_PROD, NPS_PROD, HMS_COIN, NPS_SKIM, NPS_COIN, NPS_COIN_SCALER, HMS_SCALER, NPS_SCALER')
+    profile = getSpectrometerProfile(spectrometer)
+    checkDir('raw_dir', raw_dir)
 
     # Run(s)
     if parsed_args.run==None:
         raise RuntimeError('Must specify run(s) to process')
     else:
-        runs = getReplayRuns(parsed_args.run, parsed_args.disk)
+        with profilePhase('run_list'):
+            runs = getReplayRuns(parsed_args.run, parsed_args.disk, parsed_args)
 
     # Replay script to use
     if parsed_args.replay==None:
-        # User has not specified a script, so we provide them with default options
-        script_dict = { 'HMS_ALL'        : 'SCRIPTS/HMS/PRODUCTION/replay_production_all_hms.C',
-                        'NPS_ALL'       : '',
-                        'HMS_PROD'       : 'SCRIPTS/HMS/PRODUCTION/replay_production_hms.C',
-                        'NPS_PROD'      : '',
-                        'VLD_REPLAY' : 'SCRIPTS/NPS/vld_replay.C', 
-                        'HMS_COIN'       : 'SCRIPTS/HMS/PRODUCTION/replay_production_hms_coin.C',
-                        'NPS_SKIM'      : 'SCRIPTS/NPS/replay_production_skim_NPS_HMS.C',
-                        'NPS_COIN'      : 'SCRIPTS/NPS/replay_production_coin_NPS_HMS.C',
-                        'NPS_COIN_SCALER'      : '',
-                        'HMS_SCALER'     : 'SCRIPTS/HMS/SCALERS/replay_hms_scalers.C',
-                        'NPS_SCALER'    : ''}
-        replay_script = script_dict[spectrometer.upper()]
+        # User has not specified a script, so we use the spectrometer's default
+        replay_script = profile['script']
     # User specified a script so we use that one
     else:
         replay_script = parsed_args.replay[0]
@@ -193,20 +570,31 @@ def getReplayJobs(parsed_args, wf_name):
     else:
         evts = parsed_args.events[0]
 
-        if parsed_args.all_segs==None:
-            all_segs = False
-        elif parsed_args.all_segs[0].lower()=='true':
-            all_segs = True
-            #all_segs = False #Currently don't want things in MSS
-        elif parsed_args.all_segs[0].lower()=='false':
-            all_segs = False
-        else:
-            raise RuntimeError('all_segs must be True or False')
+    if parsed_args.all_segs==None:
+        all_segs = False
+    elif parsed_args.all_segs[0].lower()=='true':
+        all_segs = True
+        #all_segs = False #Currently don't want things in MSS
+    elif parsed_args.all_segs[0].lower()=='false':
+        all_segs = False
+    else:
+        raise RuntimeError('all_segs must be True or False')
+
+    # Group the segments of each run so segment 0 is staged once per group
+    if parsed_args.seg_group==None:
+        seg_group = None
+    else:
+        if all_segs==True:
+            raise RuntimeError('seg_group cannot be used with all_segs')
+        seg_group = int(parsed_args.seg_group[0])
+        runs = groupRunSegments(runs, seg_group)
 
     # Which hcswif shell script should we use? bash or csh?
     if parsed_args.shell==None:
         if all_segs==True:
             batch = os.path.join(hcswif_dir, 'hcswif2_all_segs.sh')
+        elif seg_group!=None:
+            batch = os.path.join(hcswif_dir, 'hcswif2_segs.sh')
         else:
             batch = os.path.join(hcswif_dir, 'hcswif2.sh')
     elif re.search('bash', parsed_args.shell[0]):
@@ -219,217 +607,1957 @@ def getReplayJobs(parsed_args, wf_name):
             sys.exit()
         batch = os.path.join(hcswif_dir, "hcswif_apptainer.sh")
 
-    # Create list of jobs for workflow
-    jobs = []
+    script_output = profile['output']
+    output_path = profile['output_path']
 
-    for run in runs:
-        job = {}
+    if parsed_args.specify_replay==None:
+        specify_replay=default_replay_tar
+        if not os.path.isfile(specify_replay):
+            raise ValueError('No default replay TAR found.')       
+    else:
+        specify_replay=os.path.join(parsed_args.specify_replay[0])
+        if not os.path.isfile(specify_replay):
+            raise ValueError('User defined replay path and TAR must be valid.')       
+    replay_bytes = os.path.getsize(specify_replay)
+
+    # With the replay cache, jobs unpack the tarball once per node into a
+    # directory named after its hash instead of staging and untarring it
+    if getReplayCache(parsed_args):
+        if parsed_args.apptainer:
+            raise RuntimeError('replay_cache cannot be used with apptainer')
+        replay_hash = getReplayHash(specify_replay)
+        replay_bytes = 0
+    else:
+        replay_hash = None
+
+    if parsed_args.to_mss==None:
+        to_mss = False
+    elif parsed_args.to_mss[0].lower()=='true':
+        to_mss = True
+        #to_mss = False #Currently don't want things in MSS
+    elif parsed_args.to_mss[0].lower()=='false':
+        to_mss = False
+    else:
+        raise RuntimeError('to_mss must be True or False')
 
-        # Assume coda stem looks like shms_all_XXXXX, hms_all_XXXXX, or coin_all_XXXXX
-        if 'coin' in spectrometer.lower():
-            # shms_coin and hms_coin use same coda files as coin
-            coda_stem = 'nps_coin_' + str(run[0]).zfill(4)
-        elif 'all' in spectrometer.lower():
-            # otherwise hms_all_XXXXX or shms_all_XXXXX
-            all_spec  = spectrometer.replace('_ALL', '')
-            coda_stem = 'nps_coin_' + str(run[0]).zfill(4)
-        elif 'prod' in spectrometer.lower():
-            # otherwise hms_all_XXXXX or shms_all_XXXXX
-            prod_spec = spectrometer.replace('_PROD', '')
-            coda_stem = 'nps_coin_' + str(run[0]).zfill(4)
-        elif 'scaler' in spectrometer.lower():
-            # otherwise hms_all_XXXXX or shms_all_XXXXX
-            scaler_spec = spectrometer.replace('_SCALER', '')
-            coda_stem = 'nps_coin_' + str(run[0]).zfill(4)
-        else:
-            # otherwise hms_all_XXXXX or shms_all_XXXXX
-            coda_stem = 'nps_coin_' + str(run[0]).zfill(4)
-
-#        if (run[0] > 11000 and 'shms' in spectrometer.lower()) : 
-#           coda = os.path.join(sp22_raw_dir, coda_stem + '.dat')
-#        elif (run[0] > 4000 and 'hms' in spectrometer.lower()) : 
-#           coda = os.path.join(sp22_raw_dir, coda_stem + '.dat')
-        #if(run[0]>4300 and run[0] < 16940 and 'hms' in spectrometer.lower()):
-            #coda = os.path.join(sp22_raw_dir, coda_stem + '.dat')
-        #elif (run[0] > 16940 and run[0] < 17144 and 'hms' in spectrometer.lower()) : 
-            #These are all COIN run[0]s.
-            #coda_stem = 'shms_all_' + str(run[0]).zfill(5)
-            #coda = os.path.join(cafe_raw_dir, coda_stem + '.dat')
-          
-            #TODO: Add option to run all segements of a run as output.
-        #if parsed_args.all_segments==None:
-        # Check if raw data file exist
-        coda = os.path.join(nps_raw_dir, coda_stem + '.dat.' + str(run[2]))
-        coda0 = os.path.join(nps_raw_dir, coda_stem + '.dat.0')
-        if not os.path.isfile(coda):
-            warnings.warn('RAW DATA: ' + coda + ' does not exist.')
-        if not os.path.isfile(coda0):
-            warnings.warn('RAW DATA: ' + coda0 + ' does not exist.')
-            #continue
-
-            #TODO: Fix collision between HMS rootfile names
-        output_dict = { 'HMS_ALL'             : 'ROOTfiles/hms_replay_production_all_%d_%d_%d.root',
-                        'NPS_ALL'                : '',
-                        'HMS_PROD'               : 'ROOTfiles/HMS/PRODUCTION/hms_replay_production_%d_%d_%d.root',
-                        'NPS_PROD'             : '',
-                        'VLD_REPLAY' : 'ROOTfiles/nps_%d.root',
-                        'HMS_COIN'       : 'ROOTfiles/HMS/PRODUCTION/hms_replay_production_%d_%d_%d.root',
-                        'NPS_SKIM'      : 'ROOTfiles/COIN/SKIM/nps_hms_skim_%d_%d_%d.root',
-                        'NPS_COIN'      : 'ROOTfiles/COIN/PRODUCTION/nps_hms_coin_%d_%d_1_%d.root',
-                        'NPS_COIN_SCALER' : '',
-                        'HMS_SCALER'           : 'ROOTfiles/HMS/SCALARS/hms_replay_scalars_%d_%d_%d.root',
-                        'NPS_SCALER'          : ''}
-        script_output = output_dict[spectrometer.upper()]
-
-        #No output tape path determined yet.
-        output_path_dict = { 'HMS_ALL'    : '',
-                             'NPS_ALL'                : '',
-                             'HMS_PROD'               : '',
-                             'NPS_PROD'             : '',
-                             'VLD_REPLAY' : '',
-                             'HMS_COIN'               : '',
-                             'NPS_SKIM'             : 'production/',
-                             'NPS_COIN'             : '',
-                             'NPS_COIN_SCALER' : '',
-                             'HMS_SCALER'            : '',
-                             'NPS_SCALER'          : ''}
-        output_path = output_path_dict[spectrometer.upper()]
-
-        if parsed_args.specify_replay==None:
-            specify_replay=os.path.join('/group/nps/', getpass.getuser() , 'nps_replay.tar.gz')
-            if not os.path.isfile(specify_replay):
-                raise ValueError('No default replay TAR found.')       
-        else:
-            specify_replay=os.path.join(parsed_args.specify_replay[0])
-            if not os.path.isfile(specify_replay):
-                raise ValueError('User defined replay path and TAR must be valid.')       
-                
-        if parsed_args.to_mss==None:
-            to_mss = False
-        elif parsed_args.to_mss[0].lower()=='true':
-            to_mss = True
-            #to_mss = False #Currently don't want things in MSS
-        elif parsed_args.to_mss[0].lower()=='false':
-            to_mss = False
-        else:
-            raise RuntimeError('to_mss must be True or False')
+    # Safety factor applied to the estimated disk usage
+    if parsed_args.disk_factor==None:
+        disk_factor = None
+    else:
+        disk_factor = float(parsed_args.disk_factor[0])
 
-        job['name'] =  wf_name + '_' + coda_stem + '.dat.' + str(run[2])
+    # Segment outputs are copied to the merge area and merged per run by
+    # the jobs getMergeJobs adds
+    merge = getMerge(parsed_args)
+    if merge:
+        if all_segs==True:
+            raise RuntimeError('merge cannot be used with all_segs, which already replays a run in one job')
+        if 'output_segment' in profile or script_output.count('%d') < 2:
+            raise RuntimeError('merge needs ROOT output named by segment, ' + spectrometer + ' has none')
+
+    # Resource model fitted from the logs of earlier jobs, to estimate time
+    # and RAM and to split segments into event ranges
+    split = parsed_args.split_size!=None or parsed_args.split_time!=None
+    if getEstimate(parsed_args) or parsed_args.split_time!=None or (split and parsed_args.event_bytes==None):
+        model = getResourceModel(replay_script, parsed_args)
+    else:
+        model = None
+
+    # Replay large segments in several jobs, each with a range of events
+    if split:
+        if all_segs==True or seg_group!=None or parsed_args.pack!=None or parsed_args.apptainer:
+            raise RuntimeError('split_size and split_time cannot be used with all_segs, seg_group, pack or apptainer')
+        if parsed_args.events!=None:
+            raise RuntimeError('split_size and split_time cannot be used with events')
+        runs = splitRunSegments(runs, getSplitBytes(parsed_args, model), getEventBytes(parsed_args, model, replay_script))
+
+    # Check every raw file once, in parallel, before any job is made
+    with profilePhase('preflight'):
+        raw_files = list(getReplayPaths(runs, all_segs, seg_group))
+        reportMissing('RAW DATA', preflightPaths(raw_files, getThreads(parsed_args)), len(set(raw_files)))
+
+    # Pack several segments into one multi-core job
+    if parsed_args.pack!=None:
+        if all_segs==True or seg_group!=None:
+            raise RuntimeError('pack cannot be used with all_segs or seg_group')
+        if parsed_args.apptainer:
+            raise RuntimeError('pack cannot be used with apptainer')
+        batch = os.path.join(hcswif_dir, 'hcswif2_pack.sh')
+        if getIncremental(parsed_args):
+            with profilePhase('incremental'):
+                runs = list(getIncrementalRuns(runs, parsed_args, spectrometer, script_output, output_path, evts))
+        jobs = getPackedReplayJobs(parsed_args, wf_name, runs, int(parsed_args.pack[0]), batch,
+                                   replay_script, evts, specify_replay, replay_bytes, to_mss,
+                                   script_output, output_path, disk_factor, merge)
+        if getEstimate(parsed_args):
+            jobs = estimateResources(jobs, model, parsed_args)
+        return setJobEnv(jobs, specify_replay, replay_hash)
+
+    # Jobs are generated lazily, so the workflow is never held in memory
+    def replayJobs():
+        for run in runs:
+            job = {}
+
+            # Every spectrometer of an experiment reads the same coda files
+            coda_stem = getCodaStem(run[0])
+
+                #TODO: Add option to run all segements of a run as output.
+            #if parsed_args.all_segments==None:
+            # Raw data files were checked by preflightPaths above
+            coda0 = os.path.join(raw_dir, coda_stem + '.dat.0')
+            if seg_group==None:
+                coda = os.path.join(raw_dir, coda_stem + '.dat.' + str(run[2]))
+
+            # Job names must be unique for swif2 antecedents to refer to them
+            job['name'] =  wf_name + '_' + coda_stem
+            if seg_group!=None:
+                job['name'] += '_segs%d-%d' % (run[2][0], run[2][-1])
+            elif all_segs!=True:
+                job['name'] += '_seg%d' % run[2]
+            # Event ranges are [run, size, seg, first event, last event, bytes replayed]
+            event_range = len(run) > 3
+            if event_range:
+                job['name'] += '_ev%d' % run[3]
+            job['_run'] = run[0]
+            job['constraint'] = processConstraints(parsed_args.constraint)
+            job['inputs'] = [{}]
+            job['inputs'][0]['local'] = "nps_replay.tar.gz"
+            job['inputs'][0]['remote'] = specify_replay
+
+            # Running sums of the raw bytes staged and the raw bytes replayed,
+            # used to size disk_bytes
+            input_bytes = 0
+            replayed_bytes = 0
+            if all_segs==True:
+                last_seg = run[2]+1
+                first_seg = 0
+                for seg in range(first_seg,last_seg):
+                    coda = os.path.join(raw_dir, coda_stem + '.dat.' + str(seg))
+                    inp={}
+                    inp['local'] = os.path.basename(coda)
+                    inp['remote'] = coda
+                    job['inputs'].append(inp)
+                    input_bytes += getRawSize(coda)
+                replayed_bytes = input_bytes
+            elif seg_group!=None:
+                # Segment 0 holds the run header, stage it once for all segments of the group
+                job['inputs'].append({'local': os.path.basename(coda0), 'remote': coda0})
+                input_bytes += getRawSize(coda0)
+                replayed_bytes = run[1]
+                for seg in run[2]:
+                    if seg==0:
+                        continue
+                    coda = os.path.join(raw_dir, coda_stem + '.dat.' + str(seg))
+                    job['inputs'].append({'local': os.path.basename(coda), 'remote': coda})
+                    input_bytes += getRawSize(coda)
+            else:
+                job['inputs'].append({})
+                job['inputs'][1]['local'] = os.path.basename(coda0)
+                job['inputs'][1]['remote'] = coda0
+                input_bytes += getRawSize(coda0)
+                #print(coda0)
+                # Segment 0 is already staged as the header segment
+                if run[2]!=0:
+                    job['inputs'].append({})
+                    job['inputs'][2]['local'] = os.path.basename(coda)
+                    job['inputs'][2]['remote'] = coda
+                    input_bytes += run[1]
+                replayed_bytes = run[1]
+                if event_range:
+                    replayed_bytes = run[5]
+                #print(coda)
+            # ROOT files this job is expected to write. hcana is told the last
+            # event of a range as the number of events, and the output of each
+            # range gets its own remote name.
+            if seg_group!=None:
+                segs = run[2]
+            else:
+                segs = [run[2]]
+            job['_segments'] = [[run[0], seg] for seg in segs]
+            if event_range:
+                job['_outputs'] = getReplayOutputs(spectrometer.upper(), script_output, run[0], segs, run[4])
+                remote_names = [getRangeOutput(output, run[3]) for output in job['_outputs']]
+            else:
+                job['_outputs'] = getReplayOutputs(spectrometer.upper(), script_output, run[0], segs, evts)
+                remote_names = [os.path.basename(output) for output in job['_outputs']]
+            if merge:
+                output_bytes = replayed_bytes*profile['output_ratio']/len(job['_outputs'])
+                job['outputs'], job['_merge'] = getSegmentOutputs(job['_outputs'], [run[0]]*len(job['_outputs']),
+                                                                  [output_bytes]*len(job['_outputs']), script_output,
+                                                                  evts, to_mss, output_path, wf_name, remote_names)
+            elif to_mss and job['_outputs']:
+                #DOES NOT WORK FOR EVERYTHING!!!
+                job['outputs'] = []
+                for output, name in zip(job['_outputs'], remote_names):
+                    job['outputs'].append({'local': output, 'remote': tape_out + output_path + name})
+            job['disk_bytes'] = getReplayDisk(spectrometer.upper(), input_bytes, replay_bytes, replayed_bytes, disk_factor)
+            # Raw bytes of each hcana process the job runs, one after the other
+            if seg_group!=None:
+                job['_replayed'] = [getRawSize(os.path.join(raw_dir, coda_stem + '.dat.' + str(seg))) for seg in run[2]]
+            else:
+                job['_replayed'] = [replayed_bytes]
+            #if spectrometer.upper()=='NPS_PROD':
+                #job['time_secs'] = int((run[2] / 6000 / 75)*1.2)
+            #elif spectrometer.upper()=='NPS_SCALER':
+                #job['time_secs'] = int((run[2] / 6000 / 500)*1.1)
+            
+
+            # command for job is `/hcswifdir/hcswif.sh REPLAY RUN NUMEVENTS`
+            if parsed_args.apptainer:
+                 job['command'] = [" ".join([batch, replay_script, str(run), str(evts), str(parsed_args.apptainer[0]), str(raw_dir)])]
+            elif seg_group!=None:
+              job['command'] = [" ".join([batch, replay_script, str(run[0]), str(evts)] + [str(seg) for seg in run[2]])]
+            elif event_range:
+              # `/hcswifdir/hcswif2.sh REPLAY RUN LASTEVENT SEGMENT FIRSTEVENT`
+              job['command'] = [" ".join([batch, replay_script, str(run[0]), str(run[4]), str(run[2]), str(run[3])])]
+            else:
+              job['command'] = [" ".join([batch, replay_script, str(run[0]), str(evts), str(run[2])])]
+     
+            yield job
+
+    jobs = replayJobs()
+    if getEstimate(parsed_args):
+        jobs = estimateResources(jobs, model, parsed_args)
+    return setJobEnv(jobs, specify_replay, replay_hash)
+
+#------------------------------------------------------------------------------
+def getReplayHash(specify_replay):
+    # Content hash of the replay tarball, the key of its node-local cache
+    sha = hashlib.sha256()
+    with open(specify_replay, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+#------------------------------------------------------------------------------
+# CODA stem the job scripts assume if HCSWIF_CODA_STEM is not set
+script_coda_stem = 'nps_coin_%04d'
+
+def setJobEnv(jobs, specify_replay, replay_hash):
+    # Tell the job script what it cannot work out itself, see
+    # hcswif_replay.sh: with the replay cache, the staged tarball is dropped
+    # and the script gets its path and hash instead, and the CODA stem of
+    # the raw files if the experiment has a different one
+    env = []
+    if replay_hash!=None:
+        env += ['HCSWIF_REPLAY_TAR=' + specify_replay, 'HCSWIF_REPLAY_HASH=' + replay_hash]
+    if coda_stem_format!=script_coda_stem:
+        env += ['HCSWIF_CODA_STEM=' + coda_stem_format]
+    for job in jobs:
+        if replay_hash!=None:
+            job['inputs'] = [inp for inp in job['inputs'] if inp['local']!='nps_replay.tar.gz']
+        if env:
+            job['command'] = [" ".join(['env'] + env + [job['command'][0]])]
+        yield job
+
+#------------------------------------------------------------------------------
+def getPackedReplayJobs(parsed_args, wf_name, runs, pack, batch, replay_script, evts,
+                        specify_replay, replay_bytes, to_mss, script_output, output_path,
+                        disk_factor, merge=False):
+    spectrometer = parsed_args.spectrometer[0].upper()
+
+    for n, slots in enumerate(packRunSegments(runs, pack)):
+        job = {}
+        job['name'] = wf_name + '_pack' + str(n)
+        job['_run'] = slots[0][0]
         job['constraint'] = processConstraints(parsed_args.constraint)
-        job['name'] =  wf_name + '_' + coda_stem
-        job['inputs'] = [{}]
-        job['inputs'][0]['local'] = "nps_replay.tar.gz"
-        job['inputs'][0]['remote'] = specify_replay
+        job['inputs'] = [{'local': 'nps_replay.tar.gz', 'remote': specify_replay}]
+
+        # Every run in the job needs its segment 0 for the header, but only once
+        input_bytes = 0
+        replayed_bytes = 0
+        staged = set()
+        for run in slots:
+            coda_stem = getCodaStem(run[0])
+            for seg in sorted(set([0, run[2]])):
+                coda = os.path.join(raw_dir, coda_stem + '.dat.' + str(seg))
+                if coda in staged:
+                    continue
+                staged.add(coda)
+                job['inputs'].append({'local': os.path.basename(coda), 'remote': coda})
+                if seg==run[2]:
+                    input_bytes += run[1]
+                else:
+                    input_bytes += getRawSize(coda)
+            replayed_bytes += run[1]
+
+        job['_outputs'] = []
+        job['_segments'] = [[run[0], run[2]] for run in slots]
+        for run in slots:
+            job['_outputs'] += getReplayOutputs(spectrometer, script_output, run[0], [run[2]], evts)
+        if merge:
+            output_ratio = getSpectrometerProfile(spectrometer)['output_ratio']
+            job['outputs'], job['_merge'] = getSegmentOutputs(job['_outputs'], [run[0] for run in slots],
+                                                              [run[1]*output_ratio for run in slots], script_output,
+                                                              evts, to_mss, output_path, wf_name)
+        elif to_mss and job['_outputs']:
+            job['outputs'] = []
+            for output in job['_outputs']:
+                job['outputs'].append({'local': output, 'remote': tape_out + output_path + os.path.basename(output)})
+
+        job['disk_bytes'] = getReplayDisk(spectrometer, input_bytes, replay_bytes, replayed_bytes, disk_factor)
+        # One core per hcana process, addCommonJobInfo scales ram_bytes to match
+        job['cpu_cores'] = len(slots)
+        # The slots run side by side, so the largest one sets the run time
+        job['_replayed'] = [max(run[1] for run in slots)]
+
+        # command for job is `/hcswifdir/hcswif2_pack.sh REPLAY NUMEVENTS RUN:SEG ...`
+        job['command'] = [" ".join([batch, replay_script, str(evts)] + ['%d:%d' % (run[0], run[2]) for run in slots])]
+
+        yield job
 
-        #Running sum of disk space required, not ideal. Start off with 1GB (for replay)
-        tmp_disk=1000000000
+#------------------------------------------------------------------------------
+def getReplayPaths(runs, all_segs, seg_group):
+    # Every raw file the replay jobs of these runs will stage
+    for run in runs:
+        coda_stem = getCodaStem(run[0])
         if all_segs==True:
-            last_seg = run[2]+1
-            first_seg = 0
-            tmp_disk=20000000000*run[2] + 30000000000
-            for seg in range(first_seg,last_seg):
-                coda = os.path.join(nps_raw_dir, coda_stem + '.dat.' + str(seg))
-                if not os.path.isfile(coda):
-                    warnings.warn('RAW DATA: ' + coda + ' does not exist.')
-                inp={}
-                inp['local'] = os.path.basename(coda)
-                inp['remote'] = coda
-                job['inputs'].append(inp)
+            segs = range(0, run[2]+1)
+        elif seg_group!=None:
+            segs = [0] + list(run[2])
         else:
-            #Specify file size as 20GB by hand, not ideal.
-            tmp_disk+=int(20000000000)
-            job['inputs'].append({})
-            job['inputs'][1]['local'] = os.path.basename(coda0)
-            job['inputs'][1]['remote'] = coda0
-            #print(coda0)
-            job['inputs'].append({})
-            job['inputs'][2]['local'] = os.path.basename(coda)
-            job['inputs'][2]['remote'] = coda
-            tmp_disk+=int(20000000000)
-            #print(coda)
+            segs = [0, run[2]]
+        for seg in segs:
+            yield os.path.join(raw_dir, coda_stem + '.dat.' + str(seg))
+
+#------------------------------------------------------------------------------
+def getReplayOutputs(spectrometer, script_output, run, segs, evts):
+    # Returns the ROOT files (relative to the job directory) that replaying
+    # the given segments of a run writes. Empty if the output name is unknown.
+    outputs = []
+    if script_output=='':
+        return outputs
+    # Some outputs (e.g. the skim) are always named after the same segment
+    # and number of events
+    profile = getSpectrometerProfile(spectrometer)
+    for seg in segs:
+        values = (int(run), int(profile.get('output_segment', seg)), int(profile.get('output_events', evts)))
+        output = script_output % values[:script_output.count('%d')]
+        if output not in outputs:
+            outputs.append(output)
+    return outputs
+
+#------------------------------------------------------------------------------
+def getMergeDir(wf_name):
+    # Where segment outputs wait to be merged
+    return os.path.join(voli_path, wf_name)
+
+#------------------------------------------------------------------------------
+def getMergedOutput(script_output, run, evts):
+    # Name of the merged ROOT file of a run: the segment output with the
+    # segment number replaced by 'all'
+    values = ('%d' % int(run), 'all', '%d' % int(evts))
+    return script_output.replace('%d', '%s') % values[:script_output.count('%d')]
+
+#------------------------------------------------------------------------------
+def getSegmentOutputs(outputs, runs, output_bytes, script_output, evts, to_mss, output_path, wf_name,
+                      remote_names=None):
+    # Copy each segment output to the merge area (as remote_names if given)
+    # and record the run it belongs to, its estimated size, the merged file
+    # it goes into, where the merged file is written and where the copy is
+    merge_dir = getMergeDir(wf_name)
+    if remote_names==None:
+        remote_names = [os.path.basename(output) for output in outputs]
+    copies = []
+    merge = {}
+    for output, run, nbytes, name in zip(outputs, runs, output_bytes, remote_names):
+        merged = os.path.basename(getMergedOutput(script_output, run, evts))
         if to_mss:
-            #DOES NOT WORK FOR EVERYTHING!!!
-            job['outputs'] = [{}]
-            if spectrometer.upper() == 'NPS_SKIM':
-                job['outputs'][0]['local'] = script_output % (int(run[0]), int(1), int(-1))
-                job['outputs'][0]['remote'] = tape_out + output_path + (os.path.basename(script_output % (int(run[0]), int(1), int(-1))))
+            remote = tape_out + output_path + merged
+        else:
+            remote = os.path.join(voli_path, merged)
+        copies.append({'local': output, 'remote': os.path.join(merge_dir, name)})
+        merge[output] = [run, merged, remote, nbytes, copies[-1]['remote']]
+    return copies, merge
+
+#------------------------------------------------------------------------------
+def getMergeJobs(jobs, wf_name, fanin, streamed, cleanup=False):
+    # Passes the segment jobs through and adds the jobs that hadd the
+    # outputs of each run, with the segment jobs as swif2 antecedents.
+    # With a fanin, runs with more outputs than that are merged in a tree
+    # of partial merges. Merge jobs follow the last job of their run if
+    # streamed (so sharding by run keeps them together), otherwise they
+    # all come at the end. With cleanup, the last merge job of a run
+    # removes the segment copies and partial merges once its hadd is done.
+    merge_dir = getMergeDir(wf_name)
+    batch = os.path.join(hcswif_dir, 'hcswif2_merge.sh')
+
+    def mergeJob(name, run, parts, local, remote, remove=None):
+        # parts are [remote, name of the job writing it, bytes], remove the
+        # files in merge_dir to remove after the hadd
+        nbytes = sum(part[2] for part in parts)
+        job = {}
+        job['name'] = name
+        job['_run'] = run
+        job['antecedents'] = sorted(set(part[1] for part in parts))
+        job['inputs'] = [{'local': os.path.basename(part[0]), 'remote': part[0]} for part in parts]
+        job['outputs'] = [{'local': local, 'remote': remote}]
+        # Room for the inputs and the merged file
+        job['disk_bytes'] = max(min_disk_bytes, int(2*nbytes))
+        # command for job is `/hcswifdir/hcswif2_merge.sh OUTPUT INPUT ... [--remove DIR FILE ...]`
+        command = [batch, local] + [os.path.basename(part[0]) for part in parts]
+        if remove:
+            command += ['--remove', merge_dir] + remove
+        job['command'] = [" ".join(command)]
+        return job
+
+    def mergeRun(merged, run, remote, parts):
+        stem, ext = os.path.splitext(merged)
+        # Every file of the merge tree is in merge_dir
+        remove = [os.path.basename(part[0]) for part in parts]
+        level = 0
+        while fanin > 1 and len(parts) > fanin:
+            merged_parts = []
+            for k in range(0, len(parts), fanin):
+                chunk = parts[k:k+fanin]
+                # A file left over on its own goes up to the next level as it is
+                if len(chunk)==1:
+                    merged_parts.append(chunk[0])
+                    continue
+                local = stem + '_part%d_%d' % (level, k//fanin) + ext
+                job = mergeJob(wf_name + '_merge_' + os.path.splitext(local)[0], run, chunk,
+                               local, os.path.join(merge_dir, local))
+                merged_parts.append([job['outputs'][0]['remote'], job['name'], sum(part[2] for part in chunk)])
+                remove.append(local)
+                yield job
+            parts = merged_parts
+            level += 1
+        if not cleanup:
+            remove = []
+        yield mergeJob(wf_name + '_merge_' + stem, run, parts, merged, remote, remove)
+
+    # Merged file -> [run, remote, parts]
+    pending = {}
+    done_runs = set()
+    last_run = None
+    for job in jobs:
+        run = job.get('_run')
+        if streamed and last_run!=None and run!=last_run:
+            for merged in [m for m in pending if pending[m][0]==last_run]:
+                for merge_job in mergeRun(merged, *pending.pop(merged)):
+                    yield merge_job
+            done_runs.add(last_run)
+        if run in done_runs:
+            raise RuntimeError('merge with shard_size needs the jobs of each run next to each other, run ' + str(run) + ' is split')
+        last_run = run
+
+        for output, (out_run, merged, remote, nbytes, copy) in job.get('_merge', {}).items():
+            part = [copy, job['name'], nbytes]
+            pending.setdefault(merged, [out_run, remote, []])[2].append(part)
+        yield job
+
+    for merged in list(pending):
+        for merge_job in mergeRun(merged, *pending.pop(merged)):
+            yield merge_job
+
+#------------------------------------------------------------------------------
+def getSplitBytes(parsed_args, model):
+    # Raw bytes replayed per job: split_size, or what the resource model
+    # expects to be replayed in split_time
+    if parsed_args.split_size!=None:
+        return int(float(parsed_args.split_size[0]))
+    if model==None:
+        raise RuntimeError('split_time needs past jobs of the replay script in std_out, use split_size instead')
+    secs = float(parsed_args.split_time[0]) - model['intercept']
+    if secs <= 0:
+        raise RuntimeError('split_time is shorter than the fixed time of a job, %.0f s' % model['intercept'])
+    return int(secs/model['secs_per_byte'])
+
+#------------------------------------------------------------------------------
+def getEventBytes(parsed_args, model, replay_script):
+    if parsed_args.event_bytes!=None:
+        return float(parsed_args.event_bytes[0])
+    if model==None or 'event_bytes' not in model:
+        raise RuntimeError('Splitting segments needs event_bytes, or past jobs of ' + replay_script + ' whose logs show the events hcana read')
+    return model['event_bytes']
+
+#------------------------------------------------------------------------------
+def splitRunSegments(runs, split_bytes, event_bytes):
+    # Segments larger than split_bytes become event ranges of about
+    # split_bytes each: [run, size, seg, first event, last event, bytes
+    # replayed]. The last range goes to the end of the segment (-1), so no
+    # event is lost if the segment has more events than estimated.
+    split = []
+    for run in runs:
+        nranges = -(-run[1]//split_bytes)
+        if nranges <= 1:
+            split.append(run)
+            continue
+        per_range = int(-(-run[1]//(event_bytes*nranges)))
+        for k in range(nranges):
+            if k < nranges - 1:
+                last = (k + 1)*per_range
             else:
-                job['outputs'][0]['local'] = script_output % (int(run[0]), int(run[2]), int(evts))
-                job['outputs'][0]['remote'] = tape_out + output_path + (os.path.basename(script_output % (int(run[0]), int(run[2]), int(evts))))
-        #This is for replay of all segments.
-        #job['disk_bytes'] = 
-        #This is for segment jobs.
-        #job['disk_bytes'] = 2*run[1] + 30000000000
-        job['disk_bytes'] = tmp_disk
-        #if spectrometer.upper()=='NPS_PROD':
-            #job['time_secs'] = int((run[2] / 6000 / 75)*1.2)
-        #elif spectrometer.upper()=='NPS_SCALER':
-            #job['time_secs'] = int((run[2] / 6000 / 500)*1.1)
-            
+                last = -1
+            split.append([run[0], run[1], run[2], k*per_range + 1, last, run[1]//nranges])
+    return split
 
-        # command for job is `/hcswifdir/hcswif.sh REPLAY RUN NUMEVENTS`
-        if parsed_args.apptainer:
-             job['command'] = [" ".join([batch, replay_script, str(run), str(evts), str(parsed_args.apptainer[0]), str(raw_dir)])]
-        else:
-          job['command'] = [" ".join([batch, replay_script, str(run[0]), str(evts), str(run[2])])]
-     
-        jobs.append(copy.deepcopy(job))
+#------------------------------------------------------------------------------
+def getRangeOutput(output, first):
+    # Remote name of the output of an event range, so the ranges of a
+    # segment do not overwrite each other
+    stem, ext = os.path.splitext(os.path.basename(output))
+    return stem + '_ev%d' % first + ext
 
-    return jobs
+#------------------------------------------------------------------------------
+def packRunSegments(runs, pack):
+    # Sort segments by size so each job gets segments of about the same size
+    # and all of its slots finish together.
+    ordered = sorted(runs, key=lambda r: r[1], reverse=True)
+    return [ordered[i:i+pack] for i in range(0, len(ordered), pack)]
 
 #------------------------------------------------------------------------------
-def getReplayRuns(run_args, disk_args):
-    runs = []
-    disk = []
-    seg = []
-    antecedent = []
+def getReplayRuns(run_args, disk_args, parsed_args=None):
+    # Size assumed for segments the run list gives no size for
+    if disk_args==None:
+        default_size = 10000000000
+    else:
+        default_size = int(disk_args[0])
+
     # User specified a file containing runs
     if (run_args[0]=='file'):
-        filelist = run_args[1]
-        f = open(filelist,'r')
-        lines = f.readlines()
+        runs = readRunList(run_args[1], default_size, parsed_args)
 
-        # We assume user has been smart enough to only specify valid run numbers
-        # or, at worst, lines only containing a \n
-        for line in lines:
-            splitted = line.split(" ")
-            if len(splitted) > 1:
-                run = splitted[0]
-                seg = splitted[1]
-                disk = splitted[2]
-            else:
-                run = line.strip('\n')
-                if disk_args==None:
-                    disk_bytes = 10000000000
-                    disk = int(disk_bytes)
-                else:
-                    disk = int(disk_args[0])
-                seg=''
-            if len(run)>0:
-                runs.append([int(run), int(disk), int(seg)])
+    # User wants the runs and segments looked up in the raw stub index
+    elif (run_args[0]=='index'):
+        entries = refreshStubIndex(raw_dir, getIndexFile(parsed_args), getThreads(parsed_args))
+        runs = queryStubIndex(entries, getRunRanges(run_args[1:]), getMinSize(parsed_args))
 
-    # Arguments are either individual runs or ranges of runs. We check with a regex
+    # Arguments are runs or ranges of runs, with or without segments, in
+    # the same syntax as a run list file
     else:
+        runs = RunList()
+        lookup = getRunSegmentLookup(parsed_args)
         for arg in run_args:
-            # Is it a range? e.g. 2040-2055
-            if re.match('^\d+-\d+$', arg):
-                limits = re.split(r'-', arg)
-                first = int(limits[0])
-                last = int(limits[1]) + 1 # range(n,m) stops at m-1
+            if not addRunListEntry(runs, [arg], default_size, lookup):
+                warnings.warn('Invalid run argument: ' + arg)
 
-                for run in range(first, last):
-                    runs.append(run)
+    return runs
 
-            # Is it a single run? e.g. 2049
-            elif re.match('^\d+$', arg):
-                runs.append(int(arg))
+#------------------------------------------------------------------------------
+# Run lists hold [run, size, segment] records. Lists of millions of segments
+# are kept in three arrays instead of one python list per segment, and the
+# records are made one at a time as the list is iterated, which it may be
+# more than once.
+class RunList:
+    def __init__(self):
+        self.runs = array.array('q')
+        self.sizes = array.array('q')
+        self.segs = array.array('q')
+
+    def append(self, record):
+        self.runs.append(record[0])
+        self.sizes.append(record[1])
+        self.segs.append(record[2])
+
+    def addSegments(self, run, segs, sizes):
+        self.runs.extend([run]*len(segs))
+        self.segs.extend(segs)
+        self.sizes.extend(sizes)
+
+    def extendPlain(self, values):
+        # values is run, segment, size, run, segment, size, ... in the
+        # order of a run list file
+        self.runs.extend(values[0::3])
+        self.segs.extend(values[1::3])
+        self.sizes.extend(values[2::3])
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __iter__(self):
+        for run, size, seg in zip(self.runs, self.sizes, self.segs):
+            yield [run, size, seg]
 
-            # Else, invalid argument so we warn and skip it
-            else:
-                warnings.warn('Invalid run argument: ' + arg)
+#------------------------------------------------------------------------------
+# A run list line is "run segment [size]" as written by make_prod_runlist.sh
+# and --mode index, or "runs[:segments] [size]" where runs is a run or a
+# range of runs and segments a comma separated list of segments and ranges
+# of segments, e.g. "2040:0-9,12". Runs without segments get every segment
+# found for them in the raw stub index. Fields may be separated by any
+# whitespace and anything after a # is a comment. Two plain numbers are
+# always "run segment", so a size for every segment of a single run needs
+# the range form, e.g. "2040-2040 2000000000".
+runlist_re = re.compile(r'^(\d+)(?:-(\d+))?(?::(\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*))?$')
+plain_runlist_re = re.compile(r'(?:[ \t]*\d+[ \t]+\d+[ \t]+\d+[ \t]*\r?\n)*')
+digits_table = str.maketrans('', '', string.digits)
+
+def readRunList(path, default_size, parsed_args=None):
+    # The list is streamed in blocks of lines, and may be gzip compressed
+    with open(path, 'rb') as f:
+        gzipped = f.read(2)==b'\x1f\x8b'
+    if gzipped:
+        f = gzip.open(path, 'rt')
+    else:
+        f = open(path, 'r')
+
+    runs = RunList()
+    lookup = getRunSegmentLookup(parsed_args)
+    with f:
+        n = 0
+        while True:
+            lines = f.readlines(1 << 20)
+            if not lines:
+                break
+
+            # Blocks of plain "run segment size" lines are converted in one
+            # go. Lines of three numbers separated by single spaces are
+            # recognized without the regex.
+            text = ''.join(lines)
+            if not text.endswith('\n'):
+                text += '\n'
+            if text.translate(digits_table)=='  \n'*len(lines):
+                # Only digits, single spaces and newlines: turned into one
+                # JSON array, whose C parser is faster than int() per field.
+                # JSON does not allow leading zeros, those take the slow way.
+                try:
+                    values = json.loads('[' + text.replace(' ', ',').replace('\n', ',')[:-1] + ']')
+                except ValueError:
+                    values = list(map(int, text.split()))
+                runs.extendPlain(array.array('q', values))
+                n += len(lines)
+                continue
+            values = text.split()
+            if len(values)==3*len(lines) and plain_runlist_re.fullmatch(text):
+                runs.extendPlain(array.array('q', map(int, values)))
+                n += len(lines)
+                continue
+
+            for line in lines:
+                n += 1
+                if '#' in line:
+                    line = line[:line.index('#')]
+                fields = line.split()
+                if fields and not addRunListEntry(runs, fields, default_size, lookup):
+                    warnings.warn('Invalid line ' + str(n) + ' in run list ' + path + ': ' + line.strip())
+    return runs
 
+#------------------------------------------------------------------------------
+def addRunListEntry(runs, fields, default_size, lookup):
+    # Adds the segments of one run list line to runs, returns False if the
+    # line could not be parsed. Plain "run segment size" lines are by far
+    # the most common, so they skip the regex.
+    if len(fields) in [2, 3] and fields[0].isdigit() and fields[1].isdigit():
+        if len(fields)==3:
+            if not fields[2].isdigit():
+                return False
+            size = int(fields[2])
+        else:
+            size = getSegmentSizes(int(fields[0]), [int(fields[1])], default_size)[0]
+        runs.append([int(fields[0]), size, int(fields[1])])
+        return True
+
+    if len(fields) > 2:
+        return False
+    match = runlist_re.match(fields[0])
+    if match==None or (len(fields)==2 and not fields[1].isdigit()):
+        return False
+    first = int(match.group(1))
+    last = first if match.group(2)==None else int(match.group(2))
+    if match.group(3)!=None:
+        segs = expandSegments(match.group(3))
+    for run in range(first, last + 1):
+        if match.group(3)==None:
+            segments = lookup(run)
+            if not segments:
+                warnings.warn('RAW DATA: no segments of run ' + str(run) + ' in the raw stub index')
+            segs = [seg for seg, size in segments]
+            sizes = [size for seg, size in segments]
+        if len(fields)==2:
+            sizes = [int(fields[1])]*len(segs)
+        elif match.group(3)!=None:
+            sizes = getSegmentSizes(run, segs, default_size)
+        runs.addSegments(run, segs, sizes)
+    return True
+
+#------------------------------------------------------------------------------
+def expandSegments(segments):
+    # "0-3,7" -> [0, 1, 2, 3, 7]
+    segs = []
+    for part in segments.split(','):
+        limits = part.split('-')
+        segs.extend(range(int(limits[0]), int(limits[-1]) + 1))
+    return segs
+
+#------------------------------------------------------------------------------
+def getSegmentSizes(run, segs, default_size):
+    # Sizes of segments the run list gives no size for, from the raw stub
+    # index if it was scanned, else from the stub itself. default_size only
+    # if neither knows the segment.
+    entries = indexed_stubs.get(raw_dir, {})
+    stem = getCodaStem(run) + '.dat.'
+    sizes = []
+    for seg in segs:
+        name = stem + str(seg)
+        if name in entries:
+            sizes.append(entries[name][2])
+            continue
+        try:
+            sizes.append(int(getStubInfo(os.path.join(raw_dir, name))['size']))
+        except (KeyError, ValueError):
+            sizes.append(default_size)
+    return sizes
+
+#------------------------------------------------------------------------------
+def getRunSegmentLookup(parsed_args):
+    # lookup(run) returns the (segment, size) of every segment of a run in
+    # the raw stub index, which is only scanned if a run without segments
+    # asks for it
+    by_run = {}
+
+    def lookup(run):
+        if not by_run:
+            entries = refreshStubIndex(raw_dir, getIndexFile(parsed_args), getThreads(parsed_args))
+            min_size = getMinSize(parsed_args)
+            for entry in entries.values():
+                if entry[2] >= min_size:
+                    by_run.setdefault(entry[0], []).append((entry[1], entry[2]))
+            for segments in by_run.values():
+                segments.sort()
+            # Do not scan the index again for every run if it is empty
+            by_run.setdefault(None, [])
+        return by_run.get(run, [])
+
+    return lookup
+
+#------------------------------------------------------------------------------
+# Disk sizing for replay jobs. output_ratio (from the spectrometer profile)
+# is the size of the ROOT output relative to the raw data replayed and
+# disk_factor is the safety factor on the total. The unpacked replay is
+# assumed to be replay_unpack_ratio times the size of the tarball.
+replay_unpack_ratio = 3
+# Size assumed for a raw segment when its stub cannot be read, and the
+# minimum scratch space requested for any job
+default_raw_size = 20000000000
+min_disk_bytes = 1000000000
+
+def getReplayDisk(spectrometer, input_bytes, replay_bytes, replayed_bytes, disk_factor=None):
+    resources = getSpectrometerProfile(spectrometer)
+    if disk_factor==None:
+        disk_factor = resources['disk_factor']
+
+    disk = input_bytes + replay_bytes*(1 + replay_unpack_ratio) + resources['output_ratio']*replayed_bytes
+    return max(int(disk*disk_factor), min_disk_bytes)
+
+#------------------------------------------------------------------------------
+# Stubs read during this invocation, keyed by path
+stub_cache = {}
+
+def getStubInfo(path):
+    if path not in stub_cache:
+        try:
+            stub_cache[path] = readStub(path)
+        except OSError:
+            stub_cache[path] = {}
+    return stub_cache[path]
+
+def getRawSize(path):
+    # Use the stub index if this directory was scanned, otherwise read the stub
+    raw_dir, name = os.path.split(path)
+    if raw_dir in indexed_stubs and name in indexed_stubs[raw_dir]:
+        return indexed_stubs[raw_dir][name][2]
+    try:
+        return int(getStubInfo(path)['size'])
+    except (KeyError, ValueError):
+        return default_raw_size
+
+def getRawTape(path):
+    # Returns (volume, position) of a file on tape, ('', 0) if unknown
+    raw_dir, name = os.path.split(path)
+    if raw_dir in indexed_stubs and name in indexed_stubs[raw_dir]:
+        entry = indexed_stubs[raw_dir][name]
+        return entry[4], entry[5]
+    return getTapeLocation(getStubInfo(path))
+
+#------------------------------------------------------------------------------
+def groupRunSegments(runs, seg_group):
+    # Collect the segments of each run, keeping the order of the run list.
+    # Returns [run, size, [segments]] with at most seg_group segments each,
+    # or every segment of the run if seg_group is 0.
+    segments = {}
+    for run in runs:
+        segments.setdefault(run[0], []).append(run)
+
+    groups = []
+    for run_number, segs in segments.items():
+        segs.sort(key=lambda r: r[2])
+        if seg_group > 0:
+            n = seg_group
+        else:
+            n = len(segs)
+        for i in range(0, len(segs), n):
+            chunk = segs[i:i+n]
+            groups.append([run_number, sum(r[1] for r in chunk), [r[2] for r in chunk]])
+
+    return groups
+
+#------------------------------------------------------------------------------
+def getRunRanges(run_args):
+    # Arguments are either individual runs or ranges of runs. We check with a regex
+    # and return a list of inclusive (first, last) pairs.
+    ranges = []
+    for arg in run_args:
+        # Is it a range? e.g. 2040-2055
+        if re.match('^\d+-\d+$', arg):
+            limits = re.split(r'-', arg)
+            ranges.append((int(limits[0]), int(limits[1])))
+
+        # Is it a single run? e.g. 2049
+        elif re.match('^\d+$', arg):
+            ranges.append((int(arg), int(arg)))
+
+        # Else, invalid argument so we warn and skip it
+        else:
+            warnings.warn('Invalid run argument: ' + arg)
+
+    return ranges
+
+#------------------------------------------------------------------------------
+# The raw stub index remembers run, segment, size and mtime of every tape stub
+# in a raw directory, so we only have to read the stubs that changed since the
+# last scan instead of running awk on every one of them.
+stub_re = getStubRe(coda_stem_format)
+
+# Index entries found by refreshStubIndex, keyed by raw directory
+indexed_stubs = {}
+
+def getIndexFile(parsed_args):
+    if parsed_args==None or parsed_args.index==None:
+        return index_file
+    return parsed_args.index[0]
+
+def getThreads(parsed_args):
+    if parsed_args==None or parsed_args.threads==None:
+        return 16
+    return int(parsed_args.threads[0])
+
+def getMinSize(parsed_args):
+    if parsed_args==None or parsed_args.min_size==None:
+        return 0
+    return int(parsed_args.min_size[0])
+
+#------------------------------------------------------------------------------
+def readStub(stub):
+    # Tape stubs are small text files of key=value lines (size=, volser=, ...)
+    info = {}
+    with open(stub, 'r') as f:
+        for line in f:
+            key, sep, value = line.strip().partition('=')
+            if sep:
+                info[key] = value
+    return info
+
+#------------------------------------------------------------------------------
+def getTapeLocation(info):
+    # Tape volume and position of a file from its stub. The key names
+    # differ between MSS versions, so accept the common spellings.
+    keys = dict((key.lower(), value) for key, value in info.items())
+    volume = ''
+    for key in ['volser', 'volume', 'vsn']:
+        if key in keys:
+            volume = keys[key]
+            break
+    position = 0
+    for key in ['filepos', 'fileposition', 'position', 'filenum', 'seqno']:
+        if key in keys:
+            try:
+                position = int(keys[key])
+            except ValueError:
+                continue
+            break
+    return volume, position
+
+#------------------------------------------------------------------------------
+def loadStubIndex(index_path):
+    if not os.path.isfile(index_path):
+        return {'dirs': {}}
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+#------------------------------------------------------------------------------
+def saveStubIndex(index, index_path):
+    # Write to a temporary file first so an interrupted scan never leaves
+    # a truncated index behind
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+
+#------------------------------------------------------------------------------
+def boundedMap(pool, fn, items, chunk_size=4096):
+    # Like pool.map, but only chunk_size items are submitted at a time, so
+    # long lists do not hold a future and a result for every item at once
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        for result in pool.map(fn, chunk):
+            yield result
+
+#------------------------------------------------------------------------------
+def refreshStubIndex(raw_dir, index_path, threads=16):
+    index = loadStubIndex(index_path)
+    entries = index['dirs'].get(raw_dir, {})
+
+    # Listing the directory does not stat anything
+    names = [e.name for e in os.scandir(raw_dir) if stub_re.match(e.name)]
+
+    # Only stubs whose mtime changed are opened again
+    def scanStub(name):
+        stub = os.path.join(raw_dir, name)
+        try:
+            mtime = os.stat(stub).st_mtime
+            entry = entries.get(name)
+            if entry!=None and len(entry)==6 and entry[3]==mtime:
+                return None
+            info = readStub(stub)
+            size = int(info.get('size', 0))
+        except (OSError, ValueError):
+            warnings.warn('RAW DATA: could not read stub ' + stub)
+            return None
+        match = stub_re.match(name)
+        volume, position = getTapeLocation(info)
+        return name, [int(match.group(1)), int(match.group(2)), size, mtime, volume, position]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        changed = [r for r in boundedMap(pool, scanStub, names) if r!=None]
+
+    present = set(names)
+    removed = [name for name in entries if name not in present]
+    for name in removed:
+        del entries[name]
+    for name, entry in changed:
+        entries[name] = entry
+
+    if changed or removed or raw_dir not in index['dirs']:
+        index['dirs'][raw_dir] = entries
+        saveStubIndex(index, index_path)
+
+    indexed_stubs[raw_dir] = entries
+    return entries
+
+#------------------------------------------------------------------------------
+def queryStubIndex(entries, run_ranges, min_size=0):
+    # Returns [run, size, segment] like a run list file, sorted by run and segment
+    runs = []
+    for entry in entries.values():
+        run, seg, size = entry[0], entry[1], entry[2]
+        if size < min_size:
+            continue
+        if run_ranges and not any(first <= run <= last for first, last in run_ranges):
+            continue
+        runs.append([run, size, seg])
+    runs.sort(key=lambda r: (r[0], r[2]))
     return runs
 
+#------------------------------------------------------------------------------
+# Result of every existence check made during this invocation, keyed by path
+stat_cache = {}
+
+def rawFileExists(path):
+    if path in stat_cache:
+        return stat_cache[path]
+    # Use the stub index if this directory was scanned, otherwise stat the file
+    raw_dir, name = os.path.split(path)
+    if raw_dir in indexed_stubs:
+        exists = name in indexed_stubs[raw_dir]
+    else:
+        exists = os.path.isfile(path)
+    stat_cache[path] = exists
+    return exists
+
+#------------------------------------------------------------------------------
+def clearCaches():
+    # The caches only hold for one invocation
+    stat_cache.clear()
+    stub_cache.clear()
+    indexed_stubs.clear()
+    checked_dirs.clear()
+
+#------------------------------------------------------------------------------
+def preflightPaths(paths, threads=16):
+    # Check each unique path once using a thread pool and return the
+    # sorted list of paths that do not exist
+    unique = set(paths)
+    unchecked = (path for path in unique if path not in stat_cache)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for exists in boundedMap(pool, rawFileExists, unchecked):
+            pass
+    return sorted(path for path in unique if not stat_cache[path])
+
+#------------------------------------------------------------------------------
+def reportMissing(label, missing, total, max_lines=20, problem='do not exist'):
+    # One warning for all missing files instead of one per file
+    if not missing:
+        return
+    report = label + ': ' + str(len(missing)) + ' of ' + str(total) + ' files ' + problem + ':'
+    for path in missing[:max_lines]:
+        report += '\n    ' + path
+    if len(missing) > max_lines:
+        report += '\n    ... and ' + str(len(missing) - max_lines) + ' more'
+    warnings.warn(report)
+
+#------------------------------------------------------------------------------
+def writeIndexRunList(parsed_args):
+    if parsed_args.run==None:
+        run_args = []
+    elif parsed_args.run[0]=='index':
+        run_args = parsed_args.run[1:]
+    else:
+        run_args = parsed_args.run
+
+    entries = refreshStubIndex(raw_dir, getIndexFile(parsed_args), getThreads(parsed_args))
+    runs = queryStubIndex(entries, getRunRanges(run_args), getMinSize(parsed_args))
+
+    # Same "run segment size" format as make_prod_runlist.sh
+    lines = ['%d %d %d\n' % (run[0], run[2], run[1]) for run in runs]
+    if parsed_args.runlist==None:
+        sys.stdout.writelines(lines)
+    else:
+        with open(parsed_args.runlist[0], 'w') as f:
+            f.writelines(lines)
+        print('Wrote: ' + parsed_args.runlist[0])
+    return
+
+#------------------------------------------------------------------------------
+def getJcacheFiles(parsed_args, action):
+    # Files of the run list to hand to jcache, and the ones to skip because
+    # they are already where the request would put them
+    if parsed_args.run==None:
+        raise RuntimeError('Must specify run(s) for jcache')
+    runs = getReplayRuns(parsed_args.run, parsed_args.disk, parsed_args)
+    cache_raw_dir = raw_dir.replace('/mss/', '/cache/', 1)
+    cache_out = tape_out.replace('/mss/', '/cache/', 1)
+
+    files = []
+    done_paths = []
+    if action in ['get', 'pin']:
+        for run in runs:
+            name = getCodaStem(run[0]) + '.dat.' + str(run[2])
+            if action=='get':
+                files.append(os.path.join(raw_dir, name))
+                done_paths.append(os.path.join(cache_raw_dir, name))
+            else:
+                files.append(os.path.join(cache_raw_dir, name))
+    elif action=='put':
+        if parsed_args.spectrometer==None:
+            raise RuntimeError('Must specify the spectrometer whose output to put')
+        spectrometer = parsed_args.spectrometer[0].upper()
+        if parsed_args.events==None:
+            evts = -1
+        else:
+            evts = parsed_args.events[0]
+        for run in runs:
+            profile = getSpectrometerProfile(spectrometer)
+            for output in getReplayOutputs(spectrometer, profile['output'], run[0], [run[2]], evts):
+                name = profile['output_path'] + os.path.basename(output)
+                if os.path.join(cache_out, name) not in files:
+                    files.append(os.path.join(cache_out, name))
+                    done_paths.append(os.path.join(tape_out, name))
+    else:
+        raise ValueError('jcache_action must be get, pin or put')
+
+    # Get skips files already on /cache and put skips files already on tape
+    skip = set()
+    if done_paths:
+        exists = set(done_paths) - set(preflightPaths(done_paths, getThreads(parsed_args)))
+        skip = set(f for f, d in zip(files, done_paths) if d in exists)
+
+    return files, skip
+
+#------------------------------------------------------------------------------
+def getJcacheCmd(parsed_args):
+    if parsed_args.jcache_cmd==None:
+        return 'jcache'
+    else:
+        return parsed_args.jcache_cmd[0]
+
+#------------------------------------------------------------------------------
+# A request that succeeded is only trusted for this long. jcache returns
+# before the files are staged or written, so a repeated call must not send
+# them again straight away, but after that only the live check on /cache
+# (or tape) counts, so files evicted from /cache are staged again. Pins
+# are trusted for as long as they last.
+jcache_pending_secs = 24*3600
+
+def runJcache(parsed_args):
+    # Concurrent replacement for the jcache/*.sh scripts: files are sent to
+    # jcache in batches with a bounded number of requests in flight, and the
+    # files of every request that succeeded are remembered in a state file so
+    # an interrupted or repeated call only sends what is left.
+    if parsed_args.jcache_action==None:
+        action = 'get'
+    else:
+        action = parsed_args.jcache_action[0].lower()
+    jcache_cmd = getJcacheCmd(parsed_args)
+    if parsed_args.batch_size==None:
+        batch_size = 100
+    else:
+        batch_size = int(parsed_args.batch_size[0])
+    if parsed_args.inflight==None:
+        inflight = 4
+    else:
+        inflight = int(parsed_args.inflight[0])
+    options = []
+    trusted_secs = jcache_pending_secs
+    if action=='pin':
+        if parsed_args.pin_days==None:
+            options = ['-D', '60']
+        else:
+            options = ['-D', parsed_args.pin_days[0]]
+        trusted_secs = float(options[1])*86400
+    elif action=='get' and parsed_args.pin_days!=None:
+        options = ['-D', parsed_args.pin_days[0]]
+
+    if parsed_args.name==None:
+        name = hcswif_prefix
+    else:
+        name = parsed_args.name[0]
+    state_file = os.path.join(json_dir, name + '_jcache_' + action + '.json')
+    # path: time of the request that succeeded. Older state files are a
+    # plain list, whose entries count as expired.
+    completed = {}
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        if isinstance(state, list):
+            state = dict.fromkeys(state, 0)
+        now = time.time()
+        completed = {path: t for path, t in state.items() if now - t < trusted_secs}
+
+    files, skip = getJcacheFiles(parsed_args, action)
+    todo = [f for f in files if f not in completed and f not in skip]
+    batches = [todo[i:i+batch_size] for i in range(0, len(todo), batch_size)]
+    print('jcache ' + action + ': ' + str(len(files)) + ' files, ' + str(len(skip)) + ' already done, ' +
+          str(len(files) - len(skip) - len(todo)) + ' sent by recent requests, ' +
+          str(len(todo)) + ' to send in ' + str(len(batches)) + ' requests')
+
+    lock = threading.Lock()
+    def saveState():
+        tmp_file = state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(completed, f, sort_keys=True)
+        os.replace(tmp_file, state_file)
+
+    def request(batch):
+        result = subprocess.run([jcache_cmd, action] + batch + options,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if result.returncode==0:
+            with lock:
+                completed.update(dict.fromkeys(batch, time.time()))
+                saveState()
+        return result
+
+    failed = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=inflight) as pool:
+        futures = [pool.submit(request, batch) for batch in batches]
+        for n, future in enumerate(concurrent.futures.as_completed(futures)):
+            result = future.result()
+            if result.returncode!=0:
+                failed += 1
+                warnings.warn('jcache ' + action + ' failed (' + str(result.returncode) + '): ' + result.stdout.strip())
+            print('jcache ' + action + ': ' + str(n+1) + '/' + str(len(batches)) + ' requests finished')
+
+    if failed > 0:
+        raise RuntimeError(str(failed) + ' jcache requests failed, run again to retry them')
+    return
+
+#------------------------------------------------------------------------------
+# Archiving of finished ROOT output. Instead of one tape write per job
+# output, the outputs of a run list are found, checked and grouped into
+# batches of about archive_size bytes, and each batch is written to tape by
+# one job, either as swif2 outputs or with jput, file by file or as one tar
+# bundle.
+default_archive_size = 50000000000
+root_magic = b'root'
+
+def getArchiveFiles(parsed_args, archived=()):
+    # Returns [path, bytes, remote] of every expected output that was
+    # found, the outputs that were not found, the ones found empty or not
+    # ROOT files, and the number already on tape, on their own or in one
+    # of the archived bundles
+    if parsed_args.run==None:
+        raise RuntimeError('Must specify run(s) to archive')
+    if parsed_args.spectrometer==None:
+        raise RuntimeError('Must specify the spectrometer whose output to archive')
+    spectrometer = parsed_args.spectrometer[0].upper()
+    profile = getSpectrometerProfile(spectrometer)
+    if profile['output']=='':
+        raise RuntimeError('No ROOT output is known for ' + spectrometer)
+    if parsed_args.events==None:
+        evts = -1
+    else:
+        evts = parsed_args.events[0]
+
+    # Outputs of every segment, or the merged output of every run
+    outputs = []
+    seen = set()
+    for run in getReplayRuns(parsed_args.run, parsed_args.disk, parsed_args):
+        if getMerge(parsed_args):
+            names = [getMergedOutput(profile['output'], run[0], evts)]
+        else:
+            names = getReplayOutputs(spectrometer, profile['output'], run[0], [run[2]], evts)
+        for output in names:
+            if output not in seen:
+                seen.add(output)
+                outputs.append(output)
+
+    output_dirs = [voli_path]
+    if parsed_args.output_dir!=None:
+        output_dirs += parsed_args.output_dir
+
+    def findOutput(output):
+        # The first candidate that is a non-empty ROOT file, else the first
+        # one that exists (a bad file) or None
+        bad = None
+        for d in output_dirs:
+            for path in [os.path.join(d, output), os.path.join(d, os.path.basename(output))]:
+                try:
+                    nbytes = os.stat(path).st_size
+                    with open(path, 'rb') as f:
+                        magic = f.read(len(root_magic))
+                except OSError:
+                    continue
+                if nbytes > 0 and magic==root_magic:
+                    return [path, nbytes, tape_out + profile['output_path'] + os.path.basename(output)]
+                if bad==None:
+                    bad = path
+        return bad
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=getThreads(parsed_args)) as pool:
+        found = list(boundedMap(pool, findOutput, outputs))
+    missing = [output for output, f in zip(outputs, found) if f==None]
+    bad = [f for f in found if isinstance(f, str)]
+    files = [f for f in found if isinstance(f, list)]
+
+    # Files already on tape are not written again
+    remotes = [f[2] for f in files]
+    on_tape = set(remotes) - set(preflightPaths(remotes, getThreads(parsed_args)))
+    files = [f for f in files if f[2] not in on_tape and f[0] not in archived]
+    return files, missing, bad, len(remotes) - len(files)
+
+#------------------------------------------------------------------------------
+def balanceBatches(files, batch_bytes):
+    # Split [path, bytes, remote] into as many batches as batch_bytes asks
+    # for, largest file first into the batch with the fewest bytes, so the
+    # batches end up about the same size
+    total = sum(f[1] for f in files)
+    nbatches = min(len(files), max(1, -(-total//batch_bytes)))
+    batches = [[0, []] for n in range(nbatches)]
+    for f in sorted(files, key=lambda f: -f[1]):
+        batch = min(batches, key=lambda b: b[0])
+        batch[0] += f[1]
+        batch[1].append(f)
+    return [sorted(b[1]) for b in batches if b[1]]
+
+#------------------------------------------------------------------------------
+def writeArchiveWorkflow(parsed_args):
+    if parsed_args.archive_size==None:
+        archive_size = default_archive_size
+    else:
+        archive_size = int(float(parsed_args.archive_size[0]))
+    if parsed_args.archive_method==None:
+        method = 'swif2'
+    else:
+        method = parsed_args.archive_method[0].lower()
+    if method not in ['swif2', 'jput']:
+        raise ValueError('archive_method must be swif2 or jput')
+    bundle = getArchiveBundle(parsed_args)
+    if parsed_args.name==None:
+        name = hcswif_prefix
+    else:
+        name = parsed_args.name[0]
+    checkDir('json_dir', json_dir)
+
+    # A rerun adds to the manifest of the earlier ones. Files in a bundle
+    # are not archived again unless the bundle is not on tape and its job
+    # failed, and new jobs (and bundles) are numbered after the earlier ones.
+    manifest_file = os.path.join(json_dir, name + '_archive_manifest.json')
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    else:
+        manifest = {'name': name + '_archive', 'batches': []}
+    bundles = [b for b in manifest['batches'] if b.get('bundle')]
+    not_on_tape = set(preflightPaths([b['tape'][0] for b in bundles], getThreads(parsed_args)))
+    waiting = [b for b in bundles if b['tape'][0] in not_on_tape]
+    entries = tailJobLogs([os.path.join(std_out, b['job'] + '.out') for b in waiting], getThreads(parsed_args))
+    failed = set(b['job'] for b, entry in zip(waiting, entries)
+                 if entry!=None and any(proc[4]!=0 for proc in entry['procs']))
+    archived = set(path for b in bundles if b['job'] not in failed for path in b['files'])
+
+    files, missing, bad, on_tape = getArchiveFiles(parsed_args, archived)
+    total = len(files) + len(missing) + len(bad) + on_tape
+    reportMissing('ROOT OUTPUT', missing, total)
+    reportMissing('ROOT OUTPUT', bad, total, problem='are empty or not ROOT files, they are not archived')
+    batches = balanceBatches(files, archive_size)
+    print('Archive: ' + str(len(files)) + ' files (' + '%.1f' % (sum(f[1] for f in files)/1e9) + ' GB) in ' +
+          str(len(batches)) + ' jobs, ' + str(on_tape) + ' already on tape or in earlier archive jobs, ' + str(len(missing)) + ' not found, ' +
+          str(len(bad)) + ' not ROOT files')
+
+    # command for job is `/hcswifdir/hcswif2_archive.sh METHOD DEST BUNDLE FILE ...`
+    # where DEST is the tape directory and BUNDLE the tar file to write, or -
+    batch_script = os.path.join(hcswif_dir, 'hcswif2_archive.sh')
+    workflow = {'name': name + '_archive', 'jobs': []}
+    first = len(manifest['batches'])
+    for n, batch in enumerate(batches, first):
+        nbytes = sum(f[1] for f in batch)
+        job = {'name': workflow['name'] + '_%03d' % n}
+        dest = os.path.dirname(batch[0][2])
+        if bundle:
+            local = job['name'] + '.tar'
+            remotes = [os.path.join(dest, local)]
+        else:
+            local = '-'
+            remotes = [f[2] for f in batch]
+        job['command'] = [" ".join([batch_script, method, dest, local] + [f[0] for f in batch])]
+        if method=='swif2':
+            if bundle:
+                job['outputs'] = [{'local': local, 'remote': remotes[0]}]
+            else:
+                job['outputs'] = [{'local': os.path.basename(f[0]), 'remote': f[2]} for f in batch]
+        # Files are only linked into the job directory, a bundle is written there
+        if bundle:
+            job['disk_bytes'] = max(min_disk_bytes, int(1.1*nbytes))
+        else:
+            job['disk_bytes'] = min_disk_bytes
+        manifest['batches'].append({'job': job['name'], 'bytes': nbytes, 'tape': remotes, 'bundle': bundle,
+                                    'files': [f[0] for f in batch]})
+        workflow['jobs'].append(job)
+
+    # Never write a bundle over one already on tape
+    if bundle:
+        remotes = [b['tape'][0] for b in manifest['batches'][first:]]
+        taken = set(remotes) - set(preflightPaths(remotes, getThreads(parsed_args)))
+        if taken:
+            raise RuntimeError('Archive bundles already on tape: ' + ', '.join(sorted(taken)) +
+                               ' (' + manifest_file + ' is missing or out of date, use another --name)')
+
+    workflow = addCommonJobInfo(workflow, parsed_args)
+    outfile = os.path.join(json_dir, workflow['name'] + '.json')
+    writeWorkflow(workflow, outfile, getCompact(parsed_args))
+
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2, separators=(',', ': '))
+    print('Wrote: ' + manifest_file + ' (' + str(len(manifest['batches'])) + ' batches)')
+
+    if getSubmit(parsed_args):
+        submitWorkflow(outfile, parsed_args)
+
+#------------------------------------------------------------------------------
+# Number of times a failed swif2 call is tried again, waiting twice as long
+# each time, starting with swif2_retry_secs
+swif2_retries = 3
+swif2_retry_secs = 5
+
+def getSwif2Cmd(parsed_args):
+    if parsed_args.swif2_cmd==None:
+        return 'swif2'
+    else:
+        return parsed_args.swif2_cmd[0]
+
+#------------------------------------------------------------------------------
+def getSwif2JobArgs(job):
+    # swif2 add-job options for a job of the workflow json
+    args = ['-name', job['name']]
+    for key, flag in [('account', '-account'), ('partition', '-partition'), ('constraint', '-constraint'),
+                      ('cpu_cores', '-cores'), ('stdout', '-stdout'), ('stderr', '-stderr')]:
+        if key in job:
+            args += [flag, str(job[key])]
+    for key, flag in [('disk_bytes', '-disk'), ('ram_bytes', '-ram')]:
+        if key in job:
+            args += [flag, '%dMB' % -(-int(job[key])//1000000)]
+    if 'time_secs' in job:
+        args += ['-time', '%ds' % int(job['time_secs'])]
+    for inp in job.get('inputs', []):
+        args += ['-input', inp['local'], inp['remote']]
+    for out in job.get('outputs', []):
+        args += ['-output', out['local'], out['remote']]
+    for antecedent in job.get('antecedents', []):
+        args += ['-antecedent', antecedent]
+    return args + shlex.split(' '.join(job['command']))
+
+#------------------------------------------------------------------------------
+def readSubmitted(name):
+    # Map the jobs of workflow name that submit added to swif2 to the time
+    # they were added, None for lines written without a time
+    submitted = {}
+    state_file = os.path.join(json_dir, name + '_submitted.txt')
+    if os.path.isfile(state_file):
+        with open(state_file, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    submitted[fields[0]] = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else None
+    return submitted
+
+#------------------------------------------------------------------------------
+def submitWorkflow(wf_file, parsed_args):
+    # Creates the workflow in swif2 and adds its jobs with a bounded number
+    # of swif2 calls in flight, each tried again a few times. Jobs that were
+    # added are appended to json_dir/<name>_submitted.txt with the time they
+    # were added, so running the same command again only adds what is left. swif2 saying a workflow or
+    # job already exists counts as success, for jobs added just before an
+    # interruption.
+    swif2_cmd = getSwif2Cmd(parsed_args)
+    if parsed_args.batch_size==None:
+        batch_size = 100
+    else:
+        batch_size = int(parsed_args.batch_size[0])
+    if parsed_args.inflight==None:
+        inflight = 4
+    else:
+        inflight = int(parsed_args.inflight[0])
+
+    with open(wf_file, 'r') as f:
+        workflow = json.load(f)
+    name = workflow['name']
+
+    def call(args):
+        # Returns None on success, otherwise the output of the last try
+        wait = swif2_retry_secs
+        for attempt in range(swif2_retries + 1):
+            result = subprocess.run([swif2_cmd] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+            if result.returncode==0 or 'already exists' in result.stdout.lower():
+                return None
+            if attempt < swif2_retries:
+                time.sleep(wait)
+                wait *= 2
+        return '(' + str(result.returncode) + ') ' + result.stdout.strip()
+
+    error = call(['create', '-workflow', name])
+    if error!=None:
+        raise RuntimeError('swif2 create -workflow ' + name + ' failed ' + error)
+
+    state_file = os.path.join(json_dir, name + '_submitted.txt')
+    added = set(readSubmitted(name))
+    todo = [job for job in workflow['jobs'] if job['name'] not in added]
+    print('swif2 ' + name + ': ' + str(len(workflow['jobs'])) + ' jobs, ' + str(len(workflow['jobs']) - len(todo)) +
+          ' added before, ' + str(len(todo)) + ' to add')
+
+    # A job is only added once its antecedents are, which is always the
+    # case for the jobs before it
+    failed = []
+    with open(state_file, 'a') as state, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=inflight) as pool:
+        for start in range(0, len(todo), batch_size):
+            pending = todo[start:start+batch_size]
+            while pending:
+                ready = [job for job in pending if all(a in added for a in job.get('antecedents', []))]
+                if not ready:
+                    failed += [job['name'] for job in pending]
+                    break
+                pending = [job for job in pending if not all(a in added for a in job.get('antecedents', []))]
+                args = [['add-job', '-workflow', name] + getSwif2JobArgs(job) for job in ready]
+                for job, error in zip(ready, pool.map(call, args)):
+                    if error==None:
+                        added.add(job['name'])
+                        state.write(job['name'] + ' ' + str(int(time.time())) + '\n')
+                    else:
+                        failed.append(job['name'])
+                        warnings.warn('swif2 add-job ' + job['name'] + ' failed ' + error)
+            state.flush()
+            print('swif2 ' + name + ': ' + str(min(start + batch_size, len(todo))) + '/' + str(len(todo)) + ' jobs sent')
+
+    if failed:
+        raise RuntimeError(str(len(failed)) + ' jobs could not be added to ' + name + ', run again to retry them')
+    print('swif2 ' + name + ': all ' + str(len(workflow['jobs'])) + ' jobs added, start it with: swif2 run -workflow ' + name)
+    return
+
+#------------------------------------------------------------------------------
+# Historical resource model. The job scripts print an HCSWIF_STATS line for
+# every hcana process (see run_hcana in hcswif_replay.sh). Per replay script
+# the run time is fitted as wall = intercept + secs_per_byte*bytes, and a job
+# asks for the estimate_quantile of the observed wall/fit ratios and of the
+# peak RSS, times estimate_margin. Staging and unpacking the replay add
+# estimate_overhead_secs per job.
+stats_re = re.compile(r'^HCSWIF_STATS (.*)$', re.M)
+# hcana prints the events it read at the end, just before the stats line
+events_re = re.compile(r'^\s*(\d+)\s+events read', re.M)
+estimate_min_samples = 10
+estimate_quantile = 0.95
+estimate_margin = 1.2
+estimate_overhead_secs = 600
+estimate_min_ram = 1000000000
+
+def getResourceDB(parsed_args):
+    if parsed_args.resource_db==None:
+        return resource_db_file
+    else:
+        return parsed_args.resource_db[0]
+
+#------------------------------------------------------------------------------
+def readJobStats(log):
+    # [script, bytes, wall, maxrss_kb, exit, events read] of every hcana
+    # process in a log
+    with open(log, 'r', errors='replace') as f:
+        text = f.read()
+    samples = []
+    start = 0
+    for match in stats_re.finditer(text):
+        fields = dict(field.split('=', 1) for field in match.group(1).split() if '=' in field)
+        events = [int(m.group(1)) for m in events_re.finditer(text, start, match.start())]
+        start = match.end()
+        try:
+            samples.append([fields['script'], int(fields['bytes']), float(fields['wall']),
+                            int(fields.get('maxrss_kb', 0)), int(fields.get('exit', 0)),
+                            events[-1] if events else 0])
+        except (KeyError, ValueError):
+            continue
+    return samples
+
+#------------------------------------------------------------------------------
+def refreshResourceDB(log_dir, db_path, threads=16):
+    # Like the raw stub index, only logs whose size or mtime changed since
+    # the last scan are read again
+    if os.path.isfile(db_path):
+        with open(db_path, 'r') as f:
+            db = json.load(f)
+    else:
+        db = {'logs': {}}
+    logs = db['logs']
+
+    try:
+        found = [(e.path, e.stat()) for e in os.scandir(log_dir) if e.name.endswith('.out')]
+    except OSError:
+        warnings.warn('std_out: could not read job logs in ' + log_dir)
+        found = []
+
+    def scanLog(item):
+        path, st = item
+        entry = logs.get(path)
+        if entry!=None and entry[0]==st.st_size and entry[1]==st.st_mtime:
+            return None
+        try:
+            return path, [st.st_size, st.st_mtime, readJobStats(path)]
+        except OSError:
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        changed = [r for r in boundedMap(pool, scanLog, found) if r!=None]
+
+    # Logs removed from std_out are kept, they are still good samples
+    for path, entry in changed:
+        logs[path] = entry
+    if changed:
+        # Same atomic write as the stub index
+        saveStubIndex(db, db_path)
+    return db
+
+#------------------------------------------------------------------------------
+def getQuantile(values, q):
+    values = sorted(values)
+    return values[int(q*(len(values) - 1))]
+
+#------------------------------------------------------------------------------
+def fitResourceModel(samples):
+    # samples are [bytes, wall, maxrss_kb, events read] of successful hcana
+    # processes
+    n = len(samples)
+    mean_x = sum(s[0] for s in samples)/n
+    mean_y = sum(s[1] for s in samples)/n
+    var_x = sum((s[0] - mean_x)**2 for s in samples)
+    if var_x > 0:
+        slope = sum((s[0] - mean_x)*(s[1] - mean_y) for s in samples)/var_x
+        intercept = mean_y - slope*mean_x
+    else:
+        slope = 0
+        intercept = 0
+    # Without a usable fit, assume the time is proportional to the size
+    if slope <= 0 or intercept < 0:
+        slope = getQuantile([s[1]/s[0] for s in samples], 0.5)
+        intercept = 0
+    ratios = [s[1]/(intercept + slope*s[0]) for s in samples]
+    rss = [s[2] for s in samples if s[2] > 0]
+
+    model = {'samples': n, 'intercept': intercept, 'secs_per_byte': slope,
+             'time_factor': max(1.0, getQuantile(ratios, estimate_quantile))*estimate_margin}
+    if rss:
+        model['ram_bytes'] = int(getQuantile(rss, estimate_quantile)*1024*estimate_margin)
+    # Average raw bytes per event, used to split segments into event ranges
+    counted = [s for s in samples if s[3] > 0]
+    if counted:
+        model['event_bytes'] = sum(s[0] for s in counted)/float(sum(s[3] for s in counted))
+    return model
+
+#------------------------------------------------------------------------------
+def getResourceModel(replay_script, parsed_args):
+    db = refreshResourceDB(std_out, getResourceDB(parsed_args), getThreads(parsed_args))
+    samples = []
+    for size, mtime, stats in db['logs'].values():
+        for stat in stats:
+            script, nbytes, wall, maxrss, exit_code = stat[:5]
+            if script==replay_script and exit_code==0 and nbytes > 0 and wall > 0:
+                samples.append([nbytes, wall, maxrss, stat[5] if len(stat) > 5 else 0])
+    if len(samples) < estimate_min_samples:
+        warnings.warn('Only ' + str(len(samples)) + ' past jobs of ' + replay_script + ' in ' + std_out + ', not estimating time and RAM')
+        return None
+
+    model = fitResourceModel(samples)
+    print('Resource model for ' + replay_script + ' from ' + str(model['samples']) + ' jobs: ' +
+          '%.0f s + %.1f s/GB' % (model['intercept'], model['secs_per_byte']*1e9) +
+          (', %.2f GB RAM' % (model['ram_bytes']/1e9) if 'ram_bytes' in model else ''))
+    return model
+
+#------------------------------------------------------------------------------
+def estimateResources(jobs, model, parsed_args):
+    # Explicit --time and --ram always win over the estimate
+    for job in jobs:
+        if model!=None and '_replayed' in job:
+            if parsed_args.time==None:
+                wall = sum(model['intercept'] + model['secs_per_byte']*nbytes for nbytes in job['_replayed'])
+                job['time_secs'] = int(estimate_overhead_secs + model['time_factor']*wall)
+            if parsed_args.ram==None and 'ram_bytes' in model:
+                job['ram_bytes'] = max(estimate_min_ram, model['ram_bytes'])*job.get('cpu_cores', 1)
+        yield job
+
+#------------------------------------------------------------------------------
+# Report on running and finished workflows from their job logs. Each log is
+# only read from where the last report stopped.
+def getWorkflowFiles(json_path, name=None):
+    # Yields (file, workflow) for the workflows in json_path, or only
+    # workflow name and its shards
+    skip = set(os.path.basename(f) for f in [index_file, resource_db_file, report_file])
+    for wf_file in sorted(glob.glob(os.path.join(json_path, '*.json'))):
+        if os.path.basename(wf_file) in skip:
+            continue
+        try:
+            with open(wf_file, 'r') as f:
+                wf = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(wf, dict) or not isinstance(wf.get('jobs'), list):
+            continue
+        if name!=None and wf.get('name')!=name and not re.match(re.escape(name) + r'_\d+$', str(wf.get('name'))):
+            continue
+        yield wf_file, wf
+
+#------------------------------------------------------------------------------
+def getWorkflowLogs(json_path, name=None):
+    # Map the stdout log of every job of the workflows in json_path (or
+    # only workflow name and its shards) to [workflow, script, constraint,
+    # time the job was submitted, stderr log]. The submit time is the one
+    # --submit recorded in <workflow>_submitted.txt, or for workflows that
+    # were added to swif2 by hand, the time the workflow json was written.
+    logs = {}
+    for wf_file, wf in getWorkflowFiles(json_path, name):
+        try:
+            written = os.path.getmtime(wf_file)
+        except OSError:
+            continue
+        submitted = readSubmitted(wf['name'])
+        for job in wf['jobs']:
+            if 'stdout' not in job:
+                continue
+            words = ' '.join(job.get('command', [])).split()
+            scripts = [w for w in words if w.endswith('.C')]
+            if scripts:
+                script = scripts[0]
+            elif words:
+                script = os.path.basename(words[0])
+            else:
+                script = ''
+            logs[job['stdout']] = [wf['name'], script, job.get('constraint', ''),
+                                   submitted.get(job['name']) or written, job.get('stderr', '')]
+    return logs
+
+#------------------------------------------------------------------------------
+def tailJobLog(path, entry):
+    # entry holds the byte offset read so far and what was found up to it:
+    # the start time and host of the job, and [bytes, wall, cpu, events,
+    # exit, run, segments] of every hcana process. A log that was truncated
+    # or rewritten (the job was retried) is read again from the start, which
+    # is noticed from its first bytes, since the start line has the time in
+    # it.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if entry!=None and (entry['inode']!=st.st_ino or st.st_size < entry['offset']):
+        entry = None
+    if entry!=None and st.st_size==entry['offset']:
+        return entry
+
+    with open(path, 'rb') as f:
+        if entry!=None and f.read(len(entry['head'])).decode('utf-8', 'replace')!=entry['head']:
+            entry = None
+        if entry==None:
+            entry = {'inode': st.st_ino, 'offset': 0, 'head': '', 'start': None, 'host': None, 'events': None, 'procs': []}
+        f.seek(entry['offset'])
+        data = f.read()
+    # Only complete lines, the rest is read next time
+    end = data.rfind(b'\n') + 1
+    if entry['offset']==0:
+        entry['head'] = data[:min(end, 64)].decode('utf-8', 'replace')
+    entry['offset'] += end
+    for line in data[:end].decode('utf-8', 'replace').splitlines():
+        if line.startswith('HCSWIF_START ') or line.startswith('HCSWIF_STATS '):
+            fields = dict(field.split('=', 1) for field in line.split()[1:] if '=' in field)
+            try:
+                if line.startswith('HCSWIF_START '):
+                    entry['start'] = int(fields['time'])
+                    entry['host'] = fields.get('host')
+                else:
+                    # hcana prints the events it read just before the stats
+                    # line, without it they are unknown (0). The events field
+                    # of older logs is the requested count, not the events read.
+                    events = entry['events'] or 0
+                    entry['procs'].append([int(fields['bytes']), float(fields['wall']),
+                                           float(fields.get('cpu', 0)), events, int(fields.get('exit', 0)),
+                                           fields.get('run', '-'), fields.get('segs', '-')])
+                    entry['events'] = None
+            except (KeyError, ValueError):
+                continue
+        else:
+            match = events_re.match(line)
+            if match:
+                entry['events'] = int(match.group(1))
+    return entry
+
+#------------------------------------------------------------------------------
+def tailJobLogs(paths, threads=16):
+    # Brings the report index up to date for these logs and returns their
+    # entries, None for logs that do not exist (jobs that never started)
+    if os.path.isfile(report_file):
+        with open(report_file, 'r') as f:
+            index = json.load(f)
+    else:
+        index = {'logs': {}}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        entries = list(boundedMap(pool, lambda path: tailJobLog(path, index['logs'].get(path)), paths))
+    for path, entry in zip(paths, entries):
+        if entry!=None:
+            index['logs'][path] = entry
+    # Same atomic write as the stub index
+    saveStubIndex(index, report_file)
+    return entries
+
+#------------------------------------------------------------------------------
+def writeReport(parsed_args):
+    if parsed_args.name==None:
+        name = None
+    else:
+        name = parsed_args.name[0]
+    logs = getWorkflowLogs(json_dir, name)
+    if not logs:
+        raise RuntimeError('No workflows found in ' + json_dir)
+
+    paths = sorted(logs)
+    threads = getThreads(parsed_args)
+    entries = tailJobLogs(paths, threads)
+
+    # Jobs are done or failed as resubmit mode sees them, so jobs killed
+    # for their memory or time limit before hcana reported count as failed
+    def classify(args):
+        path, entry = args
+        if entry==None:
+            return 'not_started'
+        return classifyJob({'stdout': path, 'stderr': logs[path][4]}, entry)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        states = list(boundedMap(pool, classify, zip(paths, entries)))
+
+    # Totals per workflow, replay script and node constraint
+    groups = {}
+    for path, entry, state in zip(paths, entries, states):
+        workflow, script, constraint, submitted, stderr = logs[path]
+        for key in [('workflow', workflow), ('script', script), ('constraint', constraint)]:
+            total = groups.setdefault(key, {'jobs': 0, 'started': 0, 'done': 0, 'failed': 0, 'events': 0,
+                                            'event_wall': 0, 'bytes': 0, 'wall': 0, 'cpu': 0, 'cpu_wall': 0, 'waits': []})
+            total['jobs'] += 1
+            if entry==None:
+                continue
+            total['started'] += 1
+            if entry['start']!=None:
+                total['waits'].append(entry['start'] - submitted)
+            if state=='done':
+                total['done'] += 1
+            elif state!='running':
+                total['failed'] += 1
+            for nbytes, wall, cpu, events, exit_code in [proc[:5] for proc in entry['procs']]:
+                total['bytes'] += nbytes
+                total['wall'] += wall
+                if events > 0:
+                    total['events'] += events
+                    total['event_wall'] += wall
+                if cpu > 0:
+                    total['cpu'] += cpu
+                    total['cpu_wall'] += wall
+
+    def ratio(a, b):
+        return a/b if b > 0 else 0
+
+    for by in ['workflow', 'script', 'constraint']:
+        print('')
+        print('%-50s %7s %7s %7s %7s %6s %9s %7s %7s %7s' % (by, 'jobs', 'started', 'done', 'failed', 'fail%',
+                                                              'events/s', 'MB/s', 'cpu_eff', 'wait_h'))
+        for key in sorted(k for k in groups if k[0]==by):
+            total = groups[key]
+            finished = total['done'] + total['failed']
+            if total['waits']:
+                wait = '%7.1f' % (getQuantile(total['waits'], 0.5)/3600.)
+            else:
+                wait = '%7s' % '-'
+            print('%-50s %7d %7d %7d %7d %6.1f %9.1f %7.1f %7.2f %s' % (
+                key[1][-50:], total['jobs'], total['started'], total['done'], total['failed'],
+                100.*ratio(total['failed'], finished), ratio(total['events'], total['event_wall']),
+                ratio(total['bytes'], total['wall'])/1e6, ratio(total['cpu'], total['cpu_wall']), wait))
+
+#------------------------------------------------------------------------------
+# Failure classes of resubmit mode, checked in this order against the end
+# of each job's stdout and stderr, with the factors applied to the RAM and
+# time of the job when it is resubmitted
+failure_classes = [('oom',           re.compile(r'oom-kill|Out Of Memory|Exceeded job memory limit|std::bad_alloc', re.I), 2, 1),
+                   ('timeout',       re.compile(r'DUE TO TIME LIMIT|time limit exceeded', re.I),                      1, 2),
+                   ('hcana',         re.compile(r'Could not find (hcana|hadd)'),                                      1, 1),
+                   ('missing_input', re.compile(r'No such file or directory|Missing or empty input|cannot open .*\.dat', re.I), 1, 1)]
+default_time_secs = 14400
+log_tail_bytes = 65536
+
+def readLogTail(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - log_tail_bytes))
+            return f.read().decode('utf-8', 'replace')
+    except OSError:
+        return ''
+
+#------------------------------------------------------------------------------
+def classifyJob(job, entry):
+    # Returns done, running (started, no result yet), not_started, or the
+    # failure class of the job. Killed jobs (OOM, time limit) may have no
+    # exit status in their log at all, so stderr is checked first.
+    if entry==None:
+        return 'not_started'
+    exits = [proc[4] for proc in entry['procs']]
+    text = readLogTail(job.get('stderr', '')) + readLogTail(job['stdout'])
+    for name, pattern, ram_factor, time_factor in failure_classes:
+        if pattern.search(text) and (name in ['oom', 'timeout'] or not exits or any(exits)):
+            return name
+    if exits and not any(exits):
+        return 'done'
+    if any(exits):
+        # SIGKILL without a message is most often the memory limit
+        if 137 in exits:
+            return 'oom'
+        return 'failed'
+    return 'running'
+
+#------------------------------------------------------------------------------
+def getSwif2Problems(wf_names, parsed_args):
+    # Map the jobs that swif2 reports a problem for (SITE_PREP_FAIL,
+    # SWIF_INPUT_FAIL, ...) to the problem. Those jobs may have failed before
+    # they wrote any log. swif2 status -jobs prints a block of "key = value"
+    # lines per job. Without swif2 the logs are all there is to go on.
+    swif2_cmd = getSwif2Cmd(parsed_args)
+    problems = {}
+    for wf_name in wf_names:
+        try:
+            result = subprocess.run([swif2_cmd, 'status', '-workflow', wf_name, '-jobs'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True)
+        except OSError as e:
+            warnings.warn('Could not run ' + swif2_cmd + ', jobs that failed before writing a log are not resubmitted: ' + str(e))
+            return problems
+        if result.returncode!=0:
+            warnings.warn('swif2 status -workflow ' + wf_name + ' failed (' + str(result.returncode) + '), ' +
+                          'jobs that failed before writing a log are not resubmitted: ' + result.stdout.strip())
+            continue
+        for block in re.split(r'\n\s*\n', result.stdout):
+            fields = dict((k.strip(), v.strip()) for k, v in
+                          (line.split('=', 1) for line in block.splitlines() if '=' in line))
+            job_name = fields.get('job_name', fields.get('name'))
+            problem = fields.get('job_attempt_problem', fields.get('problem', fields.get('problems', '')))
+            if job_name and problem and problem.lower() not in ['none', 'null', '-']:
+                problems[job_name] = problem.split(',')[0].strip().lower()
+    return problems
+
+#------------------------------------------------------------------------------
+def writeResubmitWorkflow(parsed_args):
+    if parsed_args.name==None:
+        raise RuntimeError('Must specify the workflow to resubmit with --name')
+    name = parsed_args.name[0]
+    jobs = []
+    wf_names = []
+    for wf_file, wf in getWorkflowFiles(json_dir, name):
+        jobs += wf['jobs']
+        wf_names.append(wf['name'])
+    if not jobs:
+        raise RuntimeError('No workflow ' + name + ' found in ' + json_dir)
+    threads = getThreads(parsed_args)
+
+    entries = tailJobLogs([job['stdout'] for job in jobs], threads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        states = list(boundedMap(pool, lambda args: classifyJob(*args), zip(jobs, entries)))
+
+    # A job without a log has either not run yet, or failed before it
+    # started, which only swif2 knows
+    if 'not_started' in states:
+        problems = getSwif2Problems(wf_names, parsed_args)
+        states = [problems.get(job['name'], state) if state=='not_started' else state
+                  for job, state in zip(jobs, states)]
+
+    # Failed jobs, and jobs that never started because they wait for one
+    counts = {}
+    resubmit = {}
+    for job, state in zip(jobs, states):
+        counts[state] = counts.get(state, 0) + 1
+        if state not in ['done', 'running', 'not_started']:
+            resubmit[job['name']] = state
+    waiting = True
+    while waiting:
+        waiting = False
+        for job, state in zip(jobs, states):
+            if state=='not_started' and job['name'] not in resubmit and \
+               any(a in resubmit for a in job.get('antecedents', [])):
+                resubmit[job['name']] = 'antecedent'
+                waiting = True
+
+    print('Jobs of ' + name + ': ' + ', '.join('%s %d' % (state, counts[state]) for state in sorted(counts)))
+
+    # Inputs are checked again, except those the resubmitted jobs write
+    jobs = [job for job in jobs if job['name'] in resubmit]
+    produced = set(out['remote'] for job in jobs for out in job.get('outputs', []))
+    paths = set(inp['remote'] for job in jobs for inp in job.get('inputs', [])) - produced
+    missing = set(preflightPaths(paths, threads))
+    reportMissing('INPUT', sorted(missing), len(paths))
+
+    factors = dict((c[0], c[2:]) for c in failure_classes)
+    # Jobs come after their antecedents, so a job waiting for a job that
+    # was left out is left out as well
+    dropped = []
+    def resubmitJobs():
+        for job in jobs:
+            if any(inp['remote'] in missing for inp in job.get('inputs', [])) or \
+               any(a in dropped for a in job.get('antecedents', [])):
+                dropped.append(job['name'])
+                continue
+            ram_factor, time_factor = factors.get(resubmit[job['name']], (1, 1))
+            if ram_factor!=1:
+                job['ram_bytes'] = int(job['ram_bytes']*ram_factor)
+            if time_factor!=1:
+                job['time_secs'] = int(job.get('time_secs', default_time_secs)*time_factor)
+            if 'antecedents' in job:
+                job['antecedents'] = [a for a in job['antecedents'] if a in resubmit]
+                if not job['antecedents']:
+                    del job['antecedents']
+            yield job
+
+    # The new workflow is <name>_retry1, <name>_retry2, ...
+    n = 1
+    while os.path.exists(os.path.join(json_dir, name + '_retry' + str(n) + '.json')):
+        n += 1
+    workflow = {'name': name + '_retry' + str(n), 'jobs': resubmitJobs()}
+    outfile = os.path.join(json_dir, workflow['name'] + '.json')
+    writeWorkflow(workflow, outfile, getCompact(parsed_args))
+    if dropped:
+        warnings.warn('Left out ' + str(len(dropped)) + ' jobs whose inputs do not exist: ' + ' '.join(dropped))
+
+    if getSubmit(parsed_args):
+        submitWorkflow(outfile, parsed_args)
+
 #------------------------------------------------------------------------------
 def processConstraints(swif2_constraints):
     #Constraints will come in an array if entered with space separations.
@@ -442,12 +2570,10 @@ def processConstraints(swif2_constraints):
 
     #------------------------------------------------------------------------------
 def getCommandJobs(parsed_args, wf_name):
-    print("Broken for non-PATTERN filelist input...\n See code!")
     # command for job should have been specified by user
     if parsed_args.command==None:
         raise RuntimeError('Must specify command for batch job')
 
-    jobs = []
     commands = []
 
     # User specified a text file containing commands
@@ -469,44 +2595,118 @@ def getCommandJobs(parsed_args, wf_name):
         cmd = ' '.join(str(element) for element in parsed_args.command)
         commands.append(cmd)
 
-    for cmd in commands:
-        job = {}
-        job['name'] = wf_name + '_job' + str(len(jobs))
-
-        job['command'] = [cmd]
-
-        # Add any necessary files from tape
-        if parsed_args.filelist==None:
-            warnings.warn('No file list specified. Assuming your shell script has any necessary jgets')
-        else:
-            filelist = parsed_args.filelist[0]
-            f = open(filelist,'r')
-            lines = f.readlines()
-            line0 = lines[0].split(" ")
-            lines = lines[1:]
-            if('PATTERN' in line0[0]):
-                # Broken for non-PATTERN filelist input...
-                # Which parameter of the command would we like to pattern off of?
-                parameter = line0[1] # Typically this is the run number.
-                cmd_options = cmd.split(" ")
-                param = cmd_options[int(parameter)]
-            # We assume user has been smart enough to only specify valid files
-            # or, at worst, lines only containing a \n
-            job['inputs'] = []
-            for line in lines:
-                filename = line.strip('\n')
-                filename = filename.format(param=param)
-                if len(filename)>0:
-                    if not os.path.isfile(filename):
-                        warnings.warn('RAW DATA: ' + filename + ' does not exist')
+    # Add any necessary files from tape
+    if parsed_args.filelist==None:
+        warnings.warn('No file list specified. Assuming your shell script has any necessary jgets')
+        inputs = None
+    else:
+        with profilePhase('filelist'):
+            params, templates = parseFilelist(parsed_args.filelist[0])
+            inputs = expandFilelist(commands, params, templates)
+
+        # Check every file once, in parallel, before any job is made
+        with profilePhase('preflight'):
+            all_files = set(filename for filenames in inputs for filename in filenames)
+            reportMissing('RAW DATA', preflightPaths(all_files, getThreads(parsed_args)), len(all_files))
+
+    # Jobs are generated lazily, so the workflow is never held in memory
+    def commandJobs():
+        for n, cmd in enumerate(commands):
+            job = {}
+            job['name'] = wf_name + '_job' + str(n)
+
+            job['command'] = [cmd]
+
+            if inputs!=None:
+                job['inputs'] = []
+                for filename in inputs[n]:
                     inp={}
                     inp['local'] = os.path.basename(filename)
                     inp['remote'] = filename
                     job['inputs'].append(inp)
 
-        jobs.append(copy.deepcopy(job))
+            yield job
 
-    return jobs
+    return commandJobs()
+
+#------------------------------------------------------------------------------
+def parseFilelist(filelist):
+    # A filelist is one file per line. If the first line is a PATTERN line,
+    # the files are templates filled in from the words of each command:
+    #   PATTERN 1            {param} is word 1 of the command (0 is the script)
+    #   PATTERN run=1 seg=2  {run} is word 1 and {seg} is word 2
+    # Templates may also contain glob wildcards, e.g. nps_coin_{run}.dat.*
+    with open(filelist, 'r') as f:
+        lines = [line.strip() for line in f]
+
+    params = {}
+    if lines and lines[0].split() and lines[0].split()[0]=='PATTERN':
+        for field in lines[0].split()[1:]:
+            name, sep, position = field.rpartition('=')
+            if not sep:
+                name = 'param'
+            params[name] = int(position)
+        lines = lines[1:]
+
+    # Precompile each template into the list of fields it uses
+    formatter = string.Formatter()
+    templates = []
+    for line in lines:
+        if len(line)==0:
+            continue
+        fields = [field for _, field, _, _ in formatter.parse(line) if field!=None]
+        for field in fields:
+            if field not in params:
+                raise ValueError('Filelist template ' + line + ' uses {' + field + '} which is not in the PATTERN line')
+        templates.append((line, fields))
+
+    return params, templates
+
+#------------------------------------------------------------------------------
+def expandFilelist(commands, params, templates):
+    # Returns the list of input files of each command. Commands with the same
+    # parameter values share one expansion, and each glob and directory is
+    # only listed once.
+    listings = {}
+    def expandGlob(pattern):
+        directory, name = os.path.split(pattern)
+        if directory not in listings:
+            try:
+                listings[directory] = sorted(os.listdir(directory))
+            except OSError:
+                listings[directory] = []
+        matches = [os.path.join(directory, f) for f in fnmatch.filter(listings[directory], name)]
+        for match in matches:
+            stat_cache[match] = True
+        # Keep the pattern itself if nothing matches so it gets reported
+        return matches or [pattern]
+
+    expansions = {}
+    inputs = []
+    for cmd in commands:
+        cmd_options = cmd.split()
+        try:
+            values = dict((name, cmd_options[position]) for name, position in params.items())
+        except IndexError:
+            raise ValueError('Command ' + cmd + ' does not have the words named in the PATTERN line')
+        key = tuple(sorted(values.items()))
+        if key not in expansions:
+            filenames = []
+            for template, fields in templates:
+                if fields:
+                    filename = template.format(**values)
+                else:
+                    filename = template
+                if re.search(r'[*?[]', filename):
+                    filenames += expandGlob(filename)
+                else:
+                    filenames.append(filename)
+            # A file given explicitly and matched by a glob is staged once,
+            # swif2 rejects two inputs with the same local name
+            expansions[key] = list(dict.fromkeys(filenames))
+        inputs.append(expansions[key])
+
+    return inputs
 
 #------------------------------------------------------------------------------
 def addCommonJobInfo(workflow, parsed_args):
@@ -515,9 +2715,14 @@ def addCommonJobInfo(workflow, parsed_args):
     if parsed_args.account==None:
         warnings.warn('No account specified.')
 
+        # The answer may be piped in (echo y | hcswif.py ...), but a script
+        # or batch job with nothing on stdin must not wait forever
         account_prompt = 'x'
         while account_prompt.lower() not in ['y', 'n', 'yes', 'no']:
-            account_prompt = input('Should I use account=hallc? (y/n): ')
+            try:
+                account_prompt = input('Should I use account=hallc? (y/n): ')
+            except EOFError:
+                raise RuntimeError('Please specify account as argument')
 
         if account_prompt.lower() in ['y', 'yes']:
             account = 'hallc'
@@ -556,37 +2761,564 @@ def addCommonJobInfo(workflow, parsed_args):
     else:
         shell = shutil.which(parsed_args.shell[0])
 
-    # Loop over jobs and add info
-    for n in range(0, len(workflow['jobs'])):
-        job = copy.deepcopy(workflow['jobs'][n])
+    # Fields that are the same for every job are built once and shared
+    # TODO: Allow user to specify all of these parameters
+    common = {}
+    common['account'] = account
+    common['constraint'] = processConstraints(parsed_args.constraint)
+    common['partition'] = 'production'
+    #common['disk_bytes'] = disk_bytes
+    if parsed_args.time!=None:
+        common['time_secs'] = time
+
+    checkDir('std_out', std_out)
+    checkDir('std_err', std_err)
+
+    # Add info to jobs as they are generated
+    def addInfo(jobs):
+        for job in jobs:
+            job.update(common)
+
+            job['stdout'] = os.path.join(std_out, job['name'] + '.out')
+            job['stderr'] = os.path.join(std_err, job['name'] + '.err')
+
+            # Packed jobs already ask for one core per hcana process, and
+            # estimated jobs already have their RAM
+            if 'cpu_cores' in job:
+                if 'ram_bytes' not in job:
+                    job['ram_bytes'] = ram_bytes*job['cpu_cores']
+            else:
+                if 'ram_bytes' not in job:
+                    job['ram_bytes'] = ram_bytes
+                job['cpu_cores'] = cpu
 
-        job['account'] = account
+            yield job
 
-        job['stdout'] = os.path.join(std_out, job['name'] + '.out')
-        job['stderr'] = os.path.join(std_err, job['name'] + '.err')
+    workflow['jobs'] = addInfo(workflow['jobs'])
+    return workflow
 
-        # TODO: Allow user to specify all of these parameters
-        job['constraint'] = processConstraints(parsed_args.constraint)
-        job['partition'] = 'production'
-        #job['disk_bytes'] = disk_bytes
-        job['ram_bytes'] = ram_bytes
-        job['cpu_cores'] = cpu
-        if parsed_args.time!=None:
-            job['time_secs'] = time
+#------------------------------------------------------------------------------
+def writeWorkflow(workflow, outfile, compact=False, verbose=True):
+    # Jobs are streamed to disk one at a time as they are generated. The
+    # default output is identical to json.dump(workflow, sort_keys=True, indent=2).
+    if compact:
+        indent = None
+        separators = (',', ':')
+    else:
+        indent = 2
+        separators = (',', ': ')
+
+    njobs = 0
+    with open(outfile, 'w') as f:
+        f.write('{')
+        for n, key in enumerate(sorted(workflow)):
+            if n > 0:
+                f.write(',')
+            if not compact:
+                f.write('\n  ')
+            f.write(json.dumps(key) + separators[1])
+
+            if key!='jobs':
+                value = json.dumps(workflow[key], sort_keys=True, indent=indent, separators=separators)
+                if not compact:
+                    value = value.replace('\n', '\n  ')
+                f.write(value)
+                continue
+
+            f.write('[')
+            for job in workflow['jobs']:
+                # Keys starting with an underscore are hcswif bookkeeping
+                job = {k: v for k, v in job.items() if not k.startswith('_')}
+                if njobs > 0:
+                    f.write(',')
+                if compact:
+                    f.write('\n')
+                    f.write(json.dumps(job, sort_keys=True, separators=separators))
+                else:
+                    f.write('\n    ')
+                    f.write(json.dumps(job, sort_keys=True, indent=indent, separators=separators).replace('\n', '\n    '))
+                njobs += 1
+            if njobs > 0:
+                f.write('\n' if compact else '\n  ')
+            f.write(']')
+        f.write('\n}' if not compact else '}\n')
+
+    if verbose:
+        print('Wrote: ' + outfile + ' (' + str(njobs) + ' jobs)')
+    return njobs
 
-        workflow['jobs'][n] = copy.deepcopy(job)
-        job.clear()
+#------------------------------------------------------------------------------
+def getPreviousOutputs(json_path):
+    # Map each output (local name) of the workflows already written to
+    # json_path to the places those workflows copied it to, and list the
+    # logs of their jobs
+    previous = {}
+    logs = set()
+    for wf_file in glob.glob(os.path.join(json_path, '*.json')):
+        try:
+            with open(wf_file, 'r') as f:
+                wf = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if not isinstance(wf, dict) or not isinstance(wf.get('jobs'), list):
+            continue
+        for job in wf['jobs']:
+            for output in job.get('outputs', []):
+                previous.setdefault(output['local'], set()).add(output['remote'])
+            if 'stdout' in job:
+                logs.add(job['stdout'])
+    return previous, logs
 
-    return workflow
+#------------------------------------------------------------------------------
+def getDoneCheck(parsed_args):
+    # Returns isDone(outputs, inputs, remotes, segments), True if every
+    # output (local name) exists somewhere, is not empty and is newer than
+    # the raw data inputs, and the last replay of none of the [run, segment]
+    # failed. remotes maps an output to where its job copies it.
+    #
+    # Places a finished ROOT file may be: the volatile output area, the
+    # tape output tree, its /cache copy, user directories, and wherever
+    # earlier workflows in json_dir wrote it
+    output_dirs = [voli_path]
+    if parsed_args.output_dir!=None:
+        output_dirs += parsed_args.output_dir
+    tape_dirs = [tape_out, tape_out.replace('/mss/', '/cache/', 1)]
+    previous, logs = getPreviousOutputs(json_dir)
+
+    # Exit status of the latest replay of each (run, segment) by the jobs of
+    # earlier workflows, from the HCSWIF_STATS lines in their logs
+    last_exit = {}
+    for entry in tailJobLogs(sorted(logs), getThreads(parsed_args)):
+        if entry==None or entry['start']==None:
+            continue
+        for proc in entry['procs']:
+            if len(proc) < 7 or not proc[5].isdigit():
+                continue
+            for seg in proc[6].split(','):
+                if seg.isdigit():
+                    key = (int(proc[5]), int(seg))
+                    if key not in last_exit or last_exit[key][0] <= entry['start']:
+                        last_exit[key] = (entry['start'], proc[4])
+
+    def getCandidates(output, remotes):
+        candidates = [os.path.join(d, output) for d in output_dirs]
+        candidates += [os.path.join(d, os.path.basename(output)) for d in output_dirs]
+        for d in tape_dirs:
+            if output in remotes:
+                candidates.append(remotes[output].replace(tape_out, d, 1))
+            candidates.append(os.path.join(d, os.path.basename(output)))
+        candidates += sorted(previous.get(output, []))
+        return candidates
+
+    def getMTime(path):
+        # mtime of a non-empty file, the size of a tape file is in its stub
+        try:
+            st = os.stat(path)
+            if path.startswith('/mss/'):
+                size = int(getStubInfo(path).get('size', 0))
+            else:
+                size = st.st_size
+        except (OSError, ValueError):
+            return None
+        if size <= 0:
+            return None
+        return st.st_mtime
+
+    def getInputMTime(path):
+        raw_dir, name = os.path.split(path)
+        if raw_dir in indexed_stubs and name in indexed_stubs[raw_dir]:
+            return indexed_stubs[raw_dir][name][3]
+        return getMTime(path)
+
+    def isDone(outputs, inputs, remotes, segments):
+        if not outputs:
+            return False
+        if any(last_exit.get((run, seg), (0, 0))[1]!=0 for run, seg in segments):
+            return False
+        # Only the raw data counts as input, not the replay tarball
+        newest_input = 0
+        for path in inputs:
+            if path.startswith(raw_dir):
+                newest_input = max(newest_input, getInputMTime(path) or 0)
+        for output in outputs:
+            mtimes = [getMTime(c) for c in getCandidates(output, remotes)]
+            mtimes = [m for m in mtimes if m!=None]
+            if not mtimes or max(mtimes) < newest_input:
+                return False
+        return True
+
+    return isDone
 
 #------------------------------------------------------------------------------
-def writeWorkflow(workflow, outfile):
-    with open(outfile, 'w') as f:
-        json.dump(workflow, f, sort_keys=True, indent=2, separators=(',', ': '))
+def filterDone(items, isDone, parsed_args, label):
+    # Yields the items that are not done, checked in chunks so the output
+    # directories are stat'ed in parallel
+    threads = getThreads(parsed_args)
+    counts = {'kept': 0, 'skipped': 0}
+    def flush(chunk):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            done = list(pool.map(isDone, chunk))
+        for item, is_done in zip(chunk, done):
+            if is_done:
+                counts['skipped'] += 1
+            else:
+                counts['kept'] += 1
+                yield item
+
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, 64*threads))
+        if not chunk:
+            break
+        for kept in flush(chunk):
+            yield kept
+
+    print('Incremental: skipped ' + str(counts['skipped']) + ' ' + label + ' with up to date output, kept ' + str(counts['kept']))
+
+#------------------------------------------------------------------------------
+def getIncrementalJobs(jobs, parsed_args):
+    # Only keep jobs whose outputs are missing, empty or older than their
+    # raw data, or whose segments failed the last time they were replayed
+    isDone = getDoneCheck(parsed_args)
+    def isJobDone(job):
+        remotes = dict((output['local'], output['remote']) for output in job.get('outputs', []))
+        return isDone(job.get('_outputs'), [inp['remote'] for inp in job['inputs']], remotes, job.get('_segments', []))
+    return filterDone(jobs, isJobDone, parsed_args, 'jobs')
+
+#------------------------------------------------------------------------------
+def getIncrementalRuns(runs, parsed_args, spectrometer, script_output, output_path, evts):
+    # Same for single segments [run, size, segment], before they are packed
+    # into jobs, so a pack is only made of segments that need replaying
+    isDone = getDoneCheck(parsed_args)
+    def isSegmentDone(run):
+        outputs = getReplayOutputs(spectrometer, script_output, run[0], [run[2]], evts)
+        coda_stem = getCodaStem(run[0])
+        inputs = [os.path.join(raw_dir, coda_stem + '.dat.' + str(seg)) for seg in sorted(set([0, run[2]]))]
+        remotes = dict((output, tape_out + output_path + os.path.basename(output)) for output in outputs)
+        return isDone(outputs, inputs, remotes, [[run[0], run[2]]])
+    return filterDone(runs, isSegmentDone, parsed_args, 'segments')
+
+#------------------------------------------------------------------------------
+def locateJobsOnTape(jobs, parsed_args):
+    # Set _tape and _tape_pos of each job to the tape volume and position
+    # of the segments it replays (not the segment 0 header every job
+    # stages), as the jobs stream through. Inputs that are not on tape (the
+    # replay tarball, files on disk) are ignored. With jcache_batches, the
+    # batches are written once the last job has passed.
+    locations = {}
+
+    def locateJob(job):
+        files = [inp['remote'] for inp in job.get('inputs', [])
+                 if inp['remote'].startswith('/mss/') or inp['remote'].startswith(raw_dir)]
+        for path in files:
+            if path not in locations:
+                locations[path] = getRawTape(path)
+        segments = [path for path in files if not path.endswith('.dat.0')]
+        if segments:
+            files = segments
+        if files:
+            job['_tape'], job['_tape_pos'] = min(locations[path] for path in files)
+        else:
+            job['_tape'], job['_tape_pos'] = '', 0
+        return job
+
+    # Stubs are looked up in parallel, a few thousand jobs at a time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=getThreads(parsed_args)) as pool:
+        for job in boundedMap(pool, locateJob, jobs):
+            yield job
+
+    if parsed_args.jcache_batches!=None:
+        if parsed_args.jcache_batch_size==None:
+            batch_size = 100
+        else:
+            batch_size = int(parsed_args.jcache_batch_size[0])
+        writeJcacheBatches(locations, parsed_args.jcache_batches[0], batch_size, getJcacheCmd(parsed_args))
+
+#------------------------------------------------------------------------------
+def orderJobsByTape(jobs, parsed_args):
+    # Sort jobs by tape volume and position, so swif2 stages neighbouring
+    # files from a mounted tape together instead of bouncing between
+    # volumes. This needs every job at once, sharding by tape does not.
+    return sorted(locateJobsOnTape(jobs, parsed_args), key=lambda job: (job['_tape'], job['_tape_pos']))
+
+#------------------------------------------------------------------------------
+def writeJcacheBatches(locations, outfile, batch_size, jcache_cmd='jcache'):
+    # One jcache get per tape volume (split into batches of batch_size files)
+    # with the files in the order they sit on the tape
+    volumes = {}
+    for path, (volume, position) in locations.items():
+        volumes.setdefault(volume, []).append((position, path))
 
-    print('Wrote: ' + outfile)
+    with open(outfile, 'w') as f:
+        f.write('#!/bin/bash\n')
+        for volume in sorted(volumes):
+            files = [path for position, path in sorted(volumes[volume])]
+            f.write('\n# Tape volume ' + (volume or 'unknown') + ': ' + str(len(files)) + ' files\n')
+            for i in range(0, len(files), batch_size):
+                f.write(jcache_cmd + ' get ' + ' '.join(files[i:i+batch_size]) + '\n')
+
+    print('Wrote: ' + outfile + ' (' + str(len(volumes)) + ' tape volumes)')
     return
 
+#------------------------------------------------------------------------------
+def checkShardKey(jobs, shard_by):
+    # Otherwise every job would have the same (missing) key and the whole
+    # workflow would end up in one shard
+    key = '_' + shard_by
+    for job in jobs:
+        if shard_by!='jobs' and key not in job:
+            raise RuntimeError('shard_by ' + shard_by + ' needs every job to have a ' + shard_by + ', ' +
+                               job['name'] + ' has none (use shard_by jobs)')
+        yield job
+
+#------------------------------------------------------------------------------
+def getShards(jobs, shard_size, shard_by):
+    # Group the job stream into lists of at most shard_size jobs. With
+    # shard_by run a shard may grow past shard_size to finish its last run.
+    if shard_by=='tape':
+        for shard in getTapeShards(checkShardKey(jobs, shard_by), shard_size):
+            yield shard
+        return
+    key = '_' + shard_by
+    shard = []
+    for job in checkShardKey(jobs, shard_by):
+        if len(shard) >= shard_size:
+            if shard_by=='jobs' or job[key]!=shard[-1][key]:
+                yield shard
+                shard = []
+        shard.append(job)
+    if shard:
+        yield shard
+
+#------------------------------------------------------------------------------
+def getTapeShards(jobs, shard_size):
+    # Jobs are collected per tape volume as they come, and shard_size jobs
+    # of one volume make a shard, in tape order, as soon as they are there,
+    # so only the jobs of unfinished shards are held. What is left of each
+    # volume at the end is packed into shards of whole volumes. Jobs with
+    # no tape (inputs not on tape) are split by count.
+    def tapeOrder(volume_jobs):
+        return sorted(volume_jobs, key=lambda job: job.get('_tape_pos', 0))
+
+    volumes = {}
+    for job in jobs:
+        volume_jobs = volumes.setdefault(job['_tape'], [])
+        volume_jobs.append(job)
+        if len(volume_jobs) >= shard_size:
+            yield tapeOrder(volume_jobs)
+            del volumes[job['_tape']]
+
+    shard = []
+    for volume in sorted(volumes):
+        if shard and len(shard) + len(volumes[volume]) > shard_size:
+            yield shard
+            shard = []
+        shard += tapeOrder(volumes[volume])
+    if shard:
+        yield shard
+
+#------------------------------------------------------------------------------
+def writeShardedWorkflow(workflow, outfile, parsed_args):
+    shard_size = int(parsed_args.shard_size[0])
+    if parsed_args.shard_by==None:
+        shard_by = 'jobs'
+    else:
+        shard_by = parsed_args.shard_by[0].lower()
+    if shard_by not in ['jobs', 'run', 'tape']:
+        raise ValueError('shard_by must be jobs, run or tape')
+    if shard_by=='run' and parsed_args.mode!=None and parsed_args.mode[0].lower()=='command':
+        raise RuntimeError('shard_by run needs replay jobs, command jobs have no run (use shard_by jobs or tape)')
+    compact = getCompact(parsed_args)
+    threads = getThreads(parsed_args)
+
+    # Shards are named <workflow>_000, <workflow>_001, ... next to outfile
+    out_dir = os.path.dirname(outfile)
+    manifest = {'name': workflow['name'], 'shards': []}
+
+    def writeShard(n, jobs):
+        shard = {'name': workflow['name'] + '_%03d' % n, 'jobs': jobs}
+        shard_file = os.path.join(out_dir, shard['name'] + '.json')
+        runs = [job['_run'] for job in jobs if '_run' in job]
+        entry = {'name': shard['name'], 'file': shard_file, 'jobs': len(jobs)}
+        if runs:
+            entry['first_run'] = min(runs)
+            entry['last_run'] = max(runs)
+        writeWorkflow(shard, shard_file, compact, verbose=False)
+        return entry
+
+    # Write shards in parallel, but only keep a few of them in memory at once
+    pending = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for n, jobs in enumerate(getShards(workflow['jobs'], shard_size, shard_by)):
+            pending.append(pool.submit(writeShard, n, jobs))
+            if len(pending) >= 2*threads:
+                manifest['shards'].append(pending.pop(0).result())
+        for future in pending:
+            manifest['shards'].append(future.result())
+
+    for entry in manifest['shards']:
+        print('Wrote: ' + entry['file'] + ' (' + str(entry['jobs']) + ' jobs)')
+
+    manifest_file = os.path.splitext(outfile)[0] + '_manifest.json'
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2, separators=(',', ': '))
+
+    print('Wrote: ' + manifest_file + ' (' + str(len(manifest['shards'])) + ' shards)')
+    return manifest
+
+#------------------------------------------------------------------------------
+# Profiling of the workflow generation (--profile). Jobs are streamed through
+# a chain of generators, so time is charged to the innermost phase running:
+# a phase does not count the time spent making the jobs it pulls from the
+# phase before it. Filesystem calls are counted and timed by the top
+# directory of their path, from whichever thread makes them.
+profile_calls = [(os, 'stat'), (os, 'lstat'), (os, 'scandir'), (os, 'listdir'), (builtins, 'open')]
+profile_prefixes = ['/mss/', '/cache/', '/group/', '/volatile/', '/work/', '/farm_out/', '/home/']
+profile_state = None
+
+def getProfilePrefix(args, kwargs):
+    if args:
+        path = args[0]
+    else:
+        path = kwargs.get('path', kwargs.get('file', '.'))
+    if isinstance(path, int):
+        return 'fd'
+    path = os.fspath(path)
+    if isinstance(path, bytes):
+        path = path.decode(errors='replace')
+    for prefix in profile_prefixes:
+        if path.startswith(prefix):
+            return prefix.rstrip('/')
+    return 'other'
+
+#------------------------------------------------------------------------------
+def startProfile(use_cprofile=False):
+    global profile_state
+    state = {'start': time.time(), 'phases': {}, 'stack': [], 'fs': {},
+             'lock': threading.Lock(), 'saved': [], 'cprofile': None}
+
+    # os.path.isfile, getsize, exists and glob all go through these
+    def counted(name, function):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                key = (getProfilePrefix(args, kwargs), name)
+                with state['lock']:
+                    entry = state['fs'].setdefault(key, [0, 0.])
+                    entry[0] += 1
+                    entry[1] += elapsed
+        return wrapper
+
+    for module, name in profile_calls:
+        function = getattr(module, name)
+        state['saved'].append((module, name, function))
+        setattr(module, name, counted(name, function))
+
+    if use_cprofile:
+        state['cprofile'] = cProfile.Profile()
+        state['cprofile'].enable()
+    profile_state = state
+
+#------------------------------------------------------------------------------
+def stopProfile():
+    global profile_state
+    state = profile_state
+    profile_state = None
+    if state['cprofile']!=None:
+        state['cprofile'].disable()
+    for module, name, function in state['saved']:
+        setattr(module, name, function)
+    state['wall'] = time.time() - state['start']
+    return state
+
+#------------------------------------------------------------------------------
+@contextlib.contextmanager
+def profilePhase(name):
+    # Phases are only timed in the main thread, worker threads only count
+    # their filesystem calls
+    state = profile_state
+    if state==None or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def charge(phase, secs):
+        entry = state['phases'].setdefault(phase, {'secs': 0., 'calls': 0, 'jobs': 0})
+        entry['secs'] += secs
+        return entry
+
+    # Pause the phase this one runs inside of
+    stack = state['stack']
+    now = time.time()
+    if stack:
+        charge(stack[-1][0], now - stack[-1][1])
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        now = time.time()
+        charge(name, now - stack.pop()[1])['calls'] += 1
+        if stack:
+            stack[-1][1] = now
+
+#------------------------------------------------------------------------------
+def profileJobs(name, jobs):
+    # Time each job pulled through a generator phase. Without --profile the
+    # jobs are passed on untouched.
+    state = profile_state
+    if state==None:
+        return jobs
+
+    def timedJobs():
+        iterator = iter(jobs)
+        while True:
+            with profilePhase(name):
+                try:
+                    job = next(iterator)
+                except StopIteration:
+                    return
+            state['phases'][name]['jobs'] += 1
+            yield job
+
+    return timedJobs()
+
+#------------------------------------------------------------------------------
+def writeProfile(state, outfile):
+    stem = os.path.splitext(outfile)[0]
+    wall = state['wall']
+
+    phases = state['phases']
+    accounted = sum(entry['secs'] for entry in phases.values())
+    fs = {}
+    for (prefix, name), (calls, secs) in state['fs'].items():
+        fs.setdefault(prefix, {})[name] = {'calls': calls, 'secs': round(secs, 6)}
+    profile = {'name': os.path.basename(stem), 'wall_secs': round(wall, 6),
+               'unaccounted_secs': round(wall - accounted, 6),
+               'phases': {name: dict(entry, secs=round(entry['secs'], 6)) for name, entry in phases.items()},
+               'fs': fs}
+
+    print('Profile: %.2f s' % wall)
+    print('  %-16s %10s %6s %9s' % ('phase', 'secs', '%', 'jobs'))
+    for name, entry in sorted(phases.items(), key=lambda item: -item[1]['secs']):
+        print('  %-16s %10.3f %6.1f %9d' % (name, entry['secs'], 100.*entry['secs']/max(wall, 1e-9), entry['jobs']))
+    print('  %-16s %10.3f %6.1f' % ('(other)', wall - accounted, 100.*(wall - accounted)/max(wall, 1e-9)))
+    print('  %-16s %-8s %10s %10s' % ('filesystem', 'call', 'calls', 'secs'))
+    for prefix in sorted(fs):
+        for name in sorted(fs[prefix]):
+            print('  %-16s %-8s %10d %10.3f' % (prefix, name, fs[prefix][name]['calls'], fs[prefix][name]['secs']))
+
+    profile_file = stem + '_profile.json'
+    with open(profile_file, 'w') as f:
+        json.dump(profile, f, sort_keys=True, indent=2, separators=(',', ': '))
+    print('Wrote: ' + profile_file)
+
+    if state['cprofile']!=None:
+        stats_file = stem + '_profile.prof'
+        state['cprofile'].dump_stats(stats_file)
+        print('Wrote: ' + stats_file + ' (python -m pstats ' + stats_file + ')')
+
 #------------------------------------------------------------------------------
 if __name__ == "__main__":
     main()
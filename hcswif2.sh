@@ -1,17 +1,21 @@
 #!/usr/bin/bash
 
 ARGC=$#
-if [[ $ARGC -ne 4 ]]; then
-    echo Usage: hcswif.sh SCRIPT RUN EVENTS SEGMENT
+if [[ $ARGC -ne 4 && $ARGC -ne 5 ]]; then
+    echo Usage: hcswif.sh SCRIPT RUN EVENTS SEGMENT [FIRSTEVENT]
+    echo With FIRSTEVENT, events FIRSTEVENT to EVENTS of the segment are replayed
     exit 1
 fi;
 script=$1
 run=$2
 evt=$3
 seg=$4
+first=${5:-1}
 
 # Setup environment
 hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
 source $hcswif_dir/setup.sh
 
 # Check environment
@@ -21,12 +25,19 @@ if ! [ $(command -v hcana) ]; then
 fi
 
 # Replay the run
-runHcana="hcana -q \"$script($run,$evt,1,$seg,$seg)\""
+runHcana="hcana -q \"$script($run,$evt,$first,$seg,$seg)\""
 #runHcana="hcana -q \"$script($run,$evt)\""
 
 #cd $hallc_replay_dir
-tar -xf nps_replay.tar.gz
+unpack_replay
 
 echo pwd: $(pwd)
 echo $runHcana
-eval $runHcana
+# Only part of the segment is replayed in an event range, so its size says
+# nothing about the run time
+if [[ $ARGC -eq 5 ]]; then
+    bytes=0
+else
+    bytes=$(raw_bytes $run $seg)
+fi
+run_hcana $script $run $evt $seg $bytes "$runHcana"
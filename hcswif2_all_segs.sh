@@ -12,6 +12,8 @@ seg=$4
 
 # Setup environment
 hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
 source $hcswif_dir/setup.sh
 
 # Check environment
@@ -25,8 +27,9 @@ runHcana="hcana -q \"$script($run,$evt,1,$seg,0)\""
 #runHcana="hcana -q \"$script($run,$evt)\""
 
 #cd $hallc_replay_dir
-tar -xf nps_replay.tar.gz
+unpack_replay
 
 echo pwd: $(pwd)
 echo $runHcana
-eval $runHcana
+segs=$(seq -s, 0 $seg)
+run_hcana $script $run $evt $segs $(raw_bytes $run $(seq 0 $seg)) "$runHcana"
@@ -0,0 +1,51 @@
+#!/usr/bin/bash
+
+ARGC=$#
+if [[ $ARGC -lt 4 ]]; then
+    echo Usage: hcswif2_archive.sh swif2\|jput DEST BUNDLE\|- FILE [FILE ...]
+    exit 1
+fi;
+method=$1
+dest=$2
+bundle=$3
+shift 3
+files=$@
+
+# Setup environment
+hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
+
+if [ "$method" == "jput" ] && ! [ $(command -v jput) ]; then
+    echo Could not find jput!
+    exit 1
+fi
+
+# Check the files, the job fails if any of them is missing or empty
+echo pwd: $(pwd)
+for file in $files; do
+    if ! [ -s $file ]; then
+        echo Missing or empty file: $file
+        exit 1
+    fi
+done
+
+# Link the files into the job directory, where swif2 picks up its outputs
+locals=""
+for file in $files; do
+    ln -sf $file $(basename $file)
+    locals="$locals $(basename $file)"
+done
+
+bytes=$(stat -L -c %s $files | awk '{n+=$1} END {print n}')
+if [ "$bundle" != "-" ]; then
+    echo tar -chf $bundle $locals
+    run_hcana archive - -1 - $bytes "tar -chf $bundle $locals" || exit $?
+    locals=$bundle
+fi
+
+# With swif2 the outputs are written to tape when the job ends
+if [ "$method" == "jput" ]; then
+    echo jput $locals $dest/
+    run_hcana archive - -1 - $bytes "jput $locals $dest/"
+fi
@@ -0,0 +1,56 @@
+#!/usr/bin/bash
+
+ARGC=$#
+if [[ $ARGC -lt 2 ]]; then
+    echo Usage: hcswif2_merge.sh OUTPUT INPUT [INPUT ...] [--remove DIR FILE [FILE ...]]
+    exit 1
+fi;
+output=$1
+shift
+# Files of DIR to remove once the merge succeeded: the segment copies and
+# partial merges of the run, given to the last merge job of the run
+inputs=""
+remove_dir=""
+remove=""
+while [[ $# -gt 0 ]]; do
+    if [ "$1" == "--remove" ]; then
+        remove_dir=$2
+        shift 2
+        remove="$@"
+        break
+    fi
+    inputs="$inputs $1"
+    shift
+done
+
+# Setup environment
+hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
+source $hcswif_dir/setup.sh
+
+# Check environment
+if ! [ $(command -v hadd) ]; then
+    echo Could not find hadd! Please edit $hcswif_dir/setup.sh appropriately
+    exit 1
+fi
+
+# Merge the segment outputs, the job fails if any of them is missing
+echo pwd: $(pwd)
+for input in $inputs; do
+    if ! [ -s $input ]; then
+        echo Missing or empty input: $input
+        exit 1
+    fi
+done
+
+bytes=$(stat -L -c %s $inputs | awk '{n+=$1} END {print n}')
+echo hadd -f $output $inputs
+run_hcana hadd - -1 - $bytes "hadd -f $output $inputs" || exit $?
+
+if [ -n "$remove_dir" ] && [ -s $output ]; then
+    echo Removing $(echo $remove | wc -w) merged files from $remove_dir
+    for file in $remove; do
+        rm -f $remove_dir/$file
+    done
+fi
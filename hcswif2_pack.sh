@@ -0,0 +1,57 @@
+#!/usr/bin/bash
+
+ARGC=$#
+if [[ $ARGC -lt 3 ]]; then
+    echo Usage: hcswif2_pack.sh SCRIPT EVENTS RUN:SEGMENT [RUN:SEGMENT ...]
+    exit 1
+fi;
+script=$1
+evt=$2
+shift 2
+slots=$@
+
+# Setup environment
+hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
+source $hcswif_dir/setup.sh
+
+# Check environment
+if ! [ $(command -v hcana) ]; then
+    echo Could not find hcana! Please edit $hcswif_dir/setup.sh appropriately
+    exit 1
+fi
+
+# Unpack the replay once for every slot
+#cd $hallc_replay_dir
+unpack_replay
+
+echo pwd: $(pwd)
+
+# Start one hcana per slot, each writing to its own log
+declare -A pids
+for slot in $slots; do
+    run=${slot%%:*}
+    seg=${slot##*:}
+    runHcana="hcana -q \"$script($run,$evt,1,$seg,$seg)\""
+    echo $runHcana
+    run_hcana $script $run $evt $seg $(raw_bytes $run $seg) "$runHcana" > hcana_${run}_${seg}.log 2>&1 &
+    pids[$slot]=$!
+done
+
+# Wait for every slot and report its exit status
+status=0
+for slot in $slots; do
+    wait ${pids[$slot]}
+    rc=$?
+    run=${slot%%:*}
+    seg=${slot##*:}
+    echo "---------------- Run $run segment $seg ----------------"
+    cat hcana_${run}_${seg}.log
+    echo Run $run segment $seg exit status: $rc
+    if [[ $rc -ne 0 ]]; then
+        status=$rc
+    fi
+done
+
+exit $status
@@ -0,0 +1,44 @@
+#!/usr/bin/bash
+
+ARGC=$#
+if [[ $ARGC -lt 4 ]]; then
+    echo Usage: hcswif2_segs.sh SCRIPT RUN EVENTS SEGMENT [SEGMENT ...]
+    exit 1
+fi;
+script=$1
+run=$2
+evt=$3
+shift 3
+segs=$@
+
+# Setup environment
+hcswif_dir=$(dirname $(readlink -f $0))
+source $hcswif_dir/hcswif_replay.sh
+job_start
+source $hcswif_dir/setup.sh
+
+# Check environment
+if ! [ $(command -v hcana) ]; then
+    echo Could not find hcana! Please edit $hcswif_dir/setup.sh appropriately
+    exit 1
+fi
+
+#cd $hallc_replay_dir
+unpack_replay
+
+echo pwd: $(pwd)
+
+# Replay each segment in turn, all of them share the staged segment 0
+status=0
+for seg in $segs; do
+    runHcana="hcana -q \"$script($run,$evt,1,$seg,$seg)\""
+    echo $runHcana
+    run_hcana $script $run $evt $seg $(raw_bytes $run $seg) "$runHcana"
+    rc=$?
+    echo Segment $seg exit status: $rc
+    if [[ $rc -ne 0 ]]; then
+        status=$rc
+    fi
+done
+
+exit $status
@@ -0,0 +1,132 @@
+#!/usr/bin/bash
+# Sourced by the hcswif job scripts to unpack nps_replay.tar.gz into the job
+# directory and to run hcana with timing.
+#
+# If the workflow was made with --replay_cache true, the tarball is not
+# staged. Instead HCSWIF_REPLAY_TAR is its path and HCSWIF_REPLAY_HASH its
+# sha256. The first job on a node unpacks it into
+# $HCSWIF_REPLAY_CACHE/<hash> (default /tmp/hcswif_replay_$USER) under a
+# lock, and every job then fills its own directory with symlinks to the
+# cached files, so output written into ROOTfiles/ etc. stays in the job.
+# A job holds a shared lock on <hash>.use for as long as it runs, and after
+# unpacking, the caches of other tarballs that no job holds are removed.
+
+unpack_replay() {
+    if [ -z "$HCSWIF_REPLAY_HASH" ]; then
+        tar -xf nps_replay.tar.gz
+        return $?
+    fi
+
+    cache_root=${HCSWIF_REPLAY_CACHE:-/tmp/hcswif_replay_$USER}
+    cache_dir=$cache_root/$HCSWIF_REPLAY_HASH
+    mkdir -p $cache_root
+
+    # Taken before the unpack lock, so the cache cannot be removed between
+    # the check below and the job using it. Released when the job exits.
+    exec 8>>$cache_dir.use
+    flock -s 8
+
+    (
+        flock -x 9
+        if [ ! -e $cache_dir/.hcswif_complete ]; then
+            echo Unpacking $HCSWIF_REPLAY_TAR into $cache_dir
+            rm -rf $cache_dir.tmp
+            mkdir -p $cache_dir.tmp
+            cp $HCSWIF_REPLAY_TAR $cache_dir.tmp.tar.gz || exit 1
+            hash=$(sha256sum $cache_dir.tmp.tar.gz | cut -d' ' -f1)
+            if [ "$hash" != "$HCSWIF_REPLAY_HASH" ]; then
+                echo $HCSWIF_REPLAY_TAR changed since the workflow was made
+                rm -rf $cache_dir.tmp $cache_dir.tmp.tar.gz
+                exit 1
+            fi
+            tar -xf $cache_dir.tmp.tar.gz -C $cache_dir.tmp || exit 1
+            rm -f $cache_dir.tmp.tar.gz
+            # Jobs only get symlinks, so make sure none of them can modify the cache
+            find $cache_dir.tmp -type f -exec chmod a-w {} +
+            rm -rf $cache_dir
+            mv $cache_dir.tmp $cache_dir
+            touch $cache_dir/.hcswif_complete
+        fi
+    ) 9>$cache_dir.lock
+    if [ $? -ne 0 ]; then
+        exec 8>&-
+        echo Could not use the replay cache, unpacking $HCSWIF_REPLAY_TAR in the job directory
+        tar -xf $HCSWIF_REPLAY_TAR
+        return $?
+    fi
+
+    echo Using cached replay $cache_dir
+    cp -rs $cache_dir/. .
+    rm -f .hcswif_complete
+    prune_replay_cache $cache_root
+}
+
+# Removes the cached replays of other tarballs that no job is using or
+# unpacking. The lock files are kept, a job may be waiting on them.
+prune_replay_cache() {
+    local cache_root=$1
+    local lock hash
+    for lock in $cache_root/*.lock; do
+        hash=$(basename $lock .lock)
+        if [ "$hash" == "$HCSWIF_REPLAY_HASH" ] || [ "$hash" == "*" ]; then
+            continue
+        fi
+        (
+            flock -x -n 7 || exit 0
+            flock -x -n 6 || exit 0
+            if [ -e $cache_root/$hash ] || [ -e $cache_root/$hash.tmp ]; then
+                echo Removing unused cached replay $cache_root/$hash
+                rm -rf $cache_root/$hash $cache_root/$hash.tmp $cache_root/$hash.tmp.tar.gz
+            fi
+        ) 7>>$lock 6>>$cache_root/$hash.use
+    done
+}
+
+# Bytes of raw data of the given segments of a run in the job directory.
+# The raw files are named with HCSWIF_CODA_STEM (a printf format of the run
+# number, set by hcswif for experiments other than NPS) + .dat.<segment>
+raw_bytes() {
+    local run=$1
+    shift
+    local total=0
+    local seg size
+    for seg in $@; do
+        size=$(stat -L -c %s $(printf ${HCSWIF_CODA_STEM:-nps_coin_%04d} $run).dat.$seg 2>/dev/null || echo 0)
+        total=$((total + size))
+    done
+    echo $total
+}
+
+# Marks the start of a job in its log for hcswif --mode report
+job_start() {
+    echo HCSWIF_START time=$(date +%s) host=$(hostname)
+}
+
+# Runs an hcana (or hadd) command and prints a line that hcswif reads back
+# from the job logs to fit its resource model (see refreshResourceDB in
+# hcswif.py) and for --mode report and --mode resubmit:
+#   HCSWIF_STATS script=S run=R segs=A,B requested=E bytes=N wall=T cpu=C maxrss_kb=K exit=X
+# requested is the number of events asked for (-1 for all). The events
+# actually read are taken from the "events read" line hcana prints. The CPU
+# time and peak RSS are only known if /usr/bin/time is installed, otherwise
+# they are 0.
+run_hcana() {
+    local script=$1 run=$2 evt=$3 segs=$4 bytes=$5 cmd=$6
+    local start=$(date +%s.%N)
+    local rc maxrss=0 user=0 sys=0
+    if [ -x /usr/bin/time ]; then
+        # $BASHPID, not $$, which is the same in every slot of hcswif2_pack.sh
+        local time_file=hcswif_time_$BASHPID
+        eval /usr/bin/time -f \"%M %U %S\" -o $time_file $cmd
+        rc=$?
+        read maxrss user sys < <(tail -1 $time_file 2>/dev/null)
+        rm -f $time_file
+    else
+        eval $cmd
+        rc=$?
+    fi
+    local wall=$(echo "$(date +%s.%N) $start" | awk '{printf "%.1f", $1-$2}')
+    local cpu=$(echo "${user:-0} ${sys:-0}" | awk '{printf "%.1f", $1+$2}')
+    echo HCSWIF_STATS script=$script run=$run segs=$segs requested=$evt bytes=$bytes wall=$wall cpu=$cpu maxrss_kb=${maxrss:-0} exit=$rc
+    return $rc
+}
@@ -1,19 +1,9 @@
-
 #!/bin/bash
 
+# Stage the raw data of a run list ("run segment size" per line, as written
+# by make_prod_runlist.sh) to /cache. Files already on /cache or sent by an
+# earlier call are skipped; rerun to retry failed requests.
 list=$1
 
-spec=$2
-
-while read line
-do
-
-if [ ${line} -gt 7000 ]; then
-    runArray+=('/mss/hallc/jpsi-007/raw/'${spec}'_all_0'${line}'.dat')
-else
-    runArray+=('/mss/hallc/spring17/raw/'${spec}'_all_0'${line}'.dat')
-fi
-
-done < ${list}
-
-eval jcache get "${runArray[*]}"
+hcswif_dir=$(dirname $(dirname $(readlink -f $0)))
+python3 $hcswif_dir/hcswif.py --mode jcache --jcache_action get --run file ${list} --batch_size 20 --inflight 4 --name $(basename ${list} .dat)
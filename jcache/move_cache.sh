@@ -1,41 +1,18 @@
 #!/bin/bash
 
-list=$1
-spec=$2
-dir=$3
-rppfx=$4
-
-SPEC=$(echo "$spec" | tr '[:lower:]' '[:upper:]')
-
-
-while read line
-do
-
-runFile='/volatile/hallc/xem2/cmorean/FullExperiment/ROOTfiles/'${SPEC}'/'${rppfx}${line}'_-1.root'
-
-
-if [ ! -f "$runFile" ]; then
-    echo "Run file $runFile does not exists."
-    exit 1
-else
-    runArray+=(${runFile}' ')
-fi
-
-done < ${list}
-
-cacheLoc='/mss/hallc/xem2/analysis/ONLINE/REPLAYS/'${SPEC}'/'${dir}'/'
-
-echo "jput ${runArray[*]} ${cacheLoc}"
-
-echo "The run files have been validated."
-echo "Does the comman look correct? i.e. is the final destination correct?"
-echo "Enter 'yes' to continue, 'no' to abort."
-read cont
-if [ "$cont" = "yes" ] || [ "$cont" = "YES" ]; then 
-    eval jput "${runArray[*]}" "${cacheLoc}"
-else
-    echo "Aborting submit!"
+# Write the ROOT output of a spectrometer (e.g. NPS_COIN) for a run list to
+# tape with jput, in jobs of about 50GB, instead of one interactive jput.
+# Writes the workflow <list>_archive.json in json_dir; add "--submit true"
+# to create it in swif2 as well. Files already on tape are skipped.
+if [[ $# -lt 2 || ( $# -ge 3 && $3 != --* ) ]]; then
+    # The old form was: move_cache.sh LIST SPEC DIR PREFIX
+    echo Usage: move_cache.sh RUNLIST SPECTROMETER [HCSWIF OPTIONS ...]
+    echo e.g. move_cache.sh runs.dat NPS_COIN --account hallc --submit true
     exit 1
 fi
+list=$1
+spec=$2
+shift 2
 
-exit 0
+hcswif_dir=$(dirname $(dirname $(readlink -f $0)))
+python3 $hcswif_dir/hcswif.py --mode archive --spectrometer ${spec} --run file ${list} --archive_method jput --name $(basename ${list} .dat) "$@"
@@ -1,18 +1,7 @@
 #!/bin/bash
 
+# Pin the raw data of a run list on /cache for 60 days
 list=$1
 
-spec=$2
-
-while read line
-do
-
-if [ ${line} -gt 7000 ]; then
-    runArray+=('/cache/hallc/jpsi-007/raw/'${spec}'_all_0'${line}'.dat')
-else
-    runArray+=('/cache/hallc/spring17/raw/'${spec}'_all_0'${line}'.dat')
-fi
-
-done < ${list}
-
-eval jcache pin "${runArray[*]}" -D 60
+hcswif_dir=$(dirname $(dirname $(readlink -f $0)))
+python3 $hcswif_dir/hcswif.py --mode jcache --jcache_action pin --pin_days 60 --run file ${list} --batch_size 20 --inflight 4 --name $(basename ${list} .dat)
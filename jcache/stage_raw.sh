@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Stage the raw data of a run list ("run segment size" per line, as written
+# by make_prod_runlist.sh) to /cache and pin it there for pin_days (default
+# 60) days. Files already on /cache or sent by a recent call are skipped;
+# rerun to retry failed requests.
+list=$1
+pinDays=${2:-60}
+
+hcswif_dir=$(dirname $(dirname $(readlink -f $0)))
+python3 $hcswif_dir/hcswif.py --mode jcache --jcache_action get --pin_days ${pinDays} --run file ${list} --batch_size 20 --inflight 4 --name $(basename ${list} .dat)
@@ -9,12 +9,7 @@ if [ -z "$rl_name" ]; then
     rl_name="runlist.dat"
 fi
 
-for run in $(seq $run_min $run_max); do 
-    for file in /mss/hallc/c-nps/raw/nps_coin_${run}.dat.*; do
-	var=`echo $file | grep -o -E "[0-9]+"`
-	var2=`grep -oP "size=\K.*" $file`
-	if [ $? -eq 0 ]; then
-	    echo $var $var2
-	fi
-    done
-done > $rl_name
+# The raw stub index only re-reads stubs that changed since the last scan.
+# Add --min_size BYTES to drop small segments.
+hcswif_dir=$(dirname $(readlink -f $0))
+python3 $hcswif_dir/hcswif.py --mode index --run $run_min-$run_max --runlist $rl_name
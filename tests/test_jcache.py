@@ -0,0 +1,118 @@
+# Tests of --mode jcache against a stand-in jcache executable, which
+# records its arguments and fails when asked to.
+#
+#   python3 -m pytest tests
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import hcswif
+
+fake_jcache = '''#!/bin/bash
+echo "$@" >> {root}/jcache_calls.txt
+if [ -e {root}/jcache_fail ]; then
+    exit 1
+fi
+'''
+
+class JcacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='hcswif_test_')
+        self.saved = {name: getattr(hcswif, name) for name in ['raw_dir', 'tape_out', 'json_dir', 'index_file']}
+        for d in ['mss/raw', 'cache/raw', 'jsons']:
+            os.makedirs(os.path.join(self.root, d))
+        hcswif.raw_dir = os.path.join(self.root, 'mss/raw')
+        hcswif.tape_out = os.path.join(self.root, 'mss/out') + '/'
+        hcswif.json_dir = os.path.join(self.root, 'jsons')
+        hcswif.index_file = os.path.join(self.root, 'jsons', 'index.json')
+
+        # 5 segments of runs 1 and 2, segment 0 of run 1 already on /cache
+        with open(os.path.join(self.root, 'runs.txt'), 'w') as f:
+            for run in [1, 2]:
+                for seg in range(5):
+                    f.write('%d %d 1000\n' % (run, seg))
+        open(os.path.join(self.root, 'cache/raw', 'nps_coin_0001.dat.0'), 'w').close()
+
+        self.jcache = os.path.join(self.root, 'jcache')
+        with open(self.jcache, 'w') as f:
+            f.write(fake_jcache.format(root=self.root))
+        os.chmod(self.jcache, 0o755)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(hcswif, name, value)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def runJcache(self, *args):
+        argv = ['--mode', 'jcache', '--run', 'file', os.path.join(self.root, 'runs.txt'), '--name', 'test',
+                '--jcache_cmd', self.jcache, '--batch_size', '4'] + list(args)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            hcswif.main(argv)
+
+    def calls(self):
+        path = os.path.join(self.root, 'jcache_calls.txt')
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r') as f:
+            return [line.split() for line in f]
+
+    def sentFiles(self):
+        return sorted(os.path.basename(arg) for call in self.calls() for arg in call if '.dat.' in arg)
+
+    def setState(self, age):
+        state_file = os.path.join(self.root, 'jsons', 'test_jcache_get.json')
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+        with open(state_file, 'w') as f:
+            json.dump({path: time.time() - age for path in state}, f)
+
+    def test_get_skips_files_on_cache(self):
+        self.runJcache()
+        calls = self.calls()
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(all(call[0]=='get' and len(call) <= 5 for call in calls))
+        self.assertEqual(len(self.sentFiles()), 9)
+        self.assertNotIn('nps_coin_0001.dat.0', self.sentFiles())
+
+    def test_repeated_get_sends_nothing(self):
+        self.runJcache()
+        self.runJcache()
+        self.assertEqual(len(self.calls()), 3)
+
+    def test_failed_requests_are_retried(self):
+        open(os.path.join(self.root, 'jcache_fail'), 'w').close()
+        with self.assertRaises(RuntimeError):
+            self.runJcache()
+        os.remove(os.path.join(self.root, 'jcache_fail'))
+        os.remove(os.path.join(self.root, 'jcache_calls.txt'))
+        self.runJcache()
+        self.assertEqual(len(self.sentFiles()), 9)
+
+    def test_evicted_files_are_staged_again(self):
+        self.runJcache()
+        os.remove(os.path.join(self.root, 'jcache_calls.txt'))
+        # A day later, only the files that made it to /cache are skipped
+        self.setState(hcswif.jcache_pending_secs + 60)
+        for name in ['nps_coin_0001.dat.1', 'nps_coin_0001.dat.2']:
+            open(os.path.join(self.root, 'cache/raw', name), 'w').close()
+        self.runJcache()
+        self.assertEqual(len(self.sentFiles()), 7)
+        self.assertNotIn('nps_coin_0001.dat.1', self.sentFiles())
+
+    def test_pin_days(self):
+        self.runJcache('--jcache_action', 'pin', '--pin_days', '30')
+        calls = self.calls()
+        self.assertTrue(all(call[0]=='pin' and call[-2:]==['-D', '30'] for call in calls))
+        self.assertEqual(len(self.sentFiles()), 10)
+
+if __name__ == '__main__':
+    unittest.main()
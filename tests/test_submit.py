@@ -0,0 +1,123 @@
+# Tests of --submit against a stand-in swif2 executable, which records its
+# arguments and fails when asked to.
+#
+#   python3 -m pytest tests
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import hcswif
+
+# A call fails once for every fail_once_<arg> file, and always while a
+# fail_<arg> file exists
+fake_swif2 = '''#!/bin/bash
+echo "$@" >> {root}/swif2_calls.txt
+for arg in "$@"; do
+    if [ -e {root}/fail_once_$arg ]; then
+        rm {root}/fail_once_$arg
+        echo swif2 error
+        exit 1
+    fi
+    if [ -e {root}/fail_$arg ]; then
+        echo swif2 error
+        exit 1
+    fi
+done
+'''
+
+class SubmitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='hcswif_test_')
+        self.saved = {name: getattr(hcswif, name) for name in ['json_dir', 'swif2_retry_secs']}
+        os.makedirs(os.path.join(self.root, 'jsons'))
+        hcswif.json_dir = os.path.join(self.root, 'jsons')
+        hcswif.swif2_retry_secs = 0
+
+        # Two replay jobs of each run and a merge job per run waiting for
+        # them, then a job waiting for both merges
+        jobs = []
+        for run in [1, 2]:
+            for seg in [0, 1]:
+                jobs.append({'name': 'test_%d_%d' % (run, seg), 'command': ['replay.sh %d %d' % (run, seg)]})
+            jobs.append({'name': 'test_%d_merge' % run, 'command': ['merge.sh %d' % run],
+                         'antecedents': ['test_%d_0' % run, 'test_%d_1' % run]})
+        jobs.append({'name': 'test_summary', 'command': ['summary.sh'],
+                     'antecedents': ['test_1_merge', 'test_2_merge']})
+        self.jobs = jobs
+        self.wf_file = os.path.join(self.root, 'jsons', 'test.json')
+        with open(self.wf_file, 'w') as f:
+            json.dump({'name': 'test', 'jobs': jobs}, f)
+
+        self.swif2 = os.path.join(self.root, 'swif2')
+        with open(self.swif2, 'w') as f:
+            f.write(fake_swif2.format(root=self.root))
+        os.chmod(self.swif2, 0o755)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(hcswif, name, value)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def submit(self, *args):
+        parsed_args = hcswif.parseArgs(['--swif2_cmd', self.swif2, '--batch_size', '3'] + list(args))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            hcswif.submitWorkflow(self.wf_file, parsed_args)
+
+    def calls(self):
+        path = os.path.join(self.root, 'swif2_calls.txt')
+        if not os.path.isfile(path):
+            return []
+        with open(path, 'r') as f:
+            return [line.split() for line in f]
+
+    def added(self):
+        # Names of the jobs of add-job calls, in the order they were made
+        return [call[call.index('-name') + 1] for call in self.calls() if call[0]=='add-job']
+
+    def fail(self, arg, once=True):
+        open(os.path.join(self.root, ('fail_once_' if once else 'fail_') + arg), 'w').close()
+
+    def test_create_once_then_jobs_in_order(self):
+        self.submit()
+        calls = self.calls()
+        self.assertEqual([call for call in calls if call[0]=='create'], [['create', '-workflow', 'test']])
+        self.assertEqual(calls[0][0], 'create')
+        added = self.added()
+        self.assertEqual(sorted(added), sorted(job['name'] for job in self.jobs))
+        for job in self.jobs:
+            for antecedent in job.get('antecedents', []):
+                self.assertLess(added.index(antecedent), added.index(job['name']))
+        merge = [call for call in calls if call[0]=='add-job' and 'test_1_merge' in call][0]
+        self.assertEqual([merge[i + 1] for i, arg in enumerate(merge) if arg=='-antecedent'], ['test_1_0', 'test_1_1'])
+
+    def test_failed_call_is_retried(self):
+        self.fail('test_1_1')
+        self.submit()
+        self.assertEqual(self.added().count('test_1_1'), 2)
+        self.assertEqual(len(set(self.added())), len(self.jobs))
+
+    def test_rerun_adds_only_remaining_jobs(self):
+        self.fail('test_2_0', once=False)
+        with self.assertRaises(RuntimeError):
+            self.submit()
+        # The job, and the jobs waiting for it, were not added
+        with open(os.path.join(self.root, 'jsons', 'test_submitted.txt'), 'r') as f:
+            submitted = [line.split()[0] for line in f]
+        self.assertEqual(sorted(submitted), ['test_1_0', 'test_1_1', 'test_1_merge', 'test_2_1'])
+
+        os.remove(os.path.join(self.root, 'fail_test_2_0'))
+        os.remove(os.path.join(self.root, 'swif2_calls.txt'))
+        self.submit()
+        self.assertEqual(sorted(self.added()), ['test_2_0', 'test_2_merge', 'test_summary'])
+        self.assertEqual(sorted(hcswif.readSubmitted('test')), sorted(job['name'] for job in self.jobs))
+
+if __name__ == '__main__':
+    unittest.main()